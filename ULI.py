@@ -3,15 +3,35 @@
 import os
 import re
 import sys
+import errno
+import fcntl
+import struct
 import select
 import time
+import shutil
+import hashlib
+import tempfile
 import yaml
 import threading
-import urllib
-import urllib2
+import Queue
+import csv
+import json
+import socket
+import random
+import SocketServer
+import BaseHTTPServer
+import httplib
+import urlparse
 import logging
+import marshal
+import shlex
+import math
+import mmap
+import stat
+import ctypes
+import ctypes.util
 
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE
 from termcolor import colored
 
 VERSION = (0, 9, 3)
@@ -22,7 +42,11 @@ __version__ = '.'.join(map(str, VERSION))
 ##******************************
 
 logger = logging.getLogger("ULI")
-lh = logging.FileHandler("/var/log/uli_install.log")
+try:
+    lh = logging.FileHandler("/var/log/uli_install.log")
+except IOError:
+    ## Tools like plan.py also run as unprivileged user
+    lh = logging.NullHandler()
 lh.setFormatter(logging.Formatter("%(asctime)s %(name)s[%(process)d] \
                                   %(levelname)s: %(message)s"))
 
@@ -33,47 +57,1495 @@ logger.setLevel(logging.DEBUG)
 ## Helper functions
 ##******************************
 
+CHUNK_SIZE = 1024 * 1024
+CACHE_DIR = "/var/cache/uli"
+IMAGE_BLOCK = 4 * 1024 * 1024
+CHUNK_IMAGE = 4 * 1024 * 1024
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+F_SETPIPE_SZ = 1031
+CDC_AVG = 1024 * 1024
+DELTA_RANGE = 16 * 1024 * 1024
 
-def execute(command, input=None, expected_rc=0):
+## Checksum files (<file>.<ext>, sha256sum format) looked for next to
+## images, configs and ULI_2.py, in this order
+CHECKSUMS = [("sha256", "sha256")]
+PEER_PORT = 8099
+PEER_SPOOL = "/dev/shm/uli_chunks"
+PEER_GROUP = "239.255.85.76"
+PEER_GROUP_PORT = 8098
+TIMELINE = "/var/log/uli_timeline"
+CONFIG_CACHE = "/tmp/uli_configs"
+JOURNAL = "/dev/shm/uli_journal"
+
+
+## Commands running at once (pipelines count once), see Process
+MAX_PROCESSES = 16
+## Output kept of commands whose output isn't wanted (the end of it)
+OUTPUT_TAIL = 64 * 1024
+LINE_END = re.compile(r'[\r\n\x08]+')
+
+process_slots = threading.BoundedSemaphore(MAX_PROCESSES)
+
+
+def set_process_limit(limit):
+    """Change MAX_PROCESSES (only while no command is running)"""
+    
+    global process_slots
+    process_slots = threading.BoundedSemaphore(limit)
+
+
+class Process:
+    """A command or a pipeline of commands running in the background
+    
+    Commands are split like a shell would (shlex) but run without one.
+    STDOUT of the last and STDERR of all commands are read line by line
+    (\\r and \\b end lines too, for the progress output of mkfs & co.)
+    as they come: every line is logged and passed to callback(line).
+    input is a string or a file-like object, which is streamed into the
+    first command chunk by chunk. keep limits the kept output to its
+    last keep bytes. Commands running longer than timeout seconds are
+    killed. progress(bytes) is called for every chunk of input fed.
+    
+    start() returns right away, wait() reaps all commands and returns
+    the output; it raises if any command didn't exit with expected_rc.
+    """
+    
+    running = set()
+    lock = threading.Lock()
+    
+    def __init__(self, commands, input=None, callback=None, timeout=None,
+                 keep=None, expected_rc=0, chunk_size=CHUNK_SIZE,
+                 name=None, progress=None):
+        if isinstance(commands, basestring):
+            commands = [commands]
+        self.commands = commands
+        self.input = input
+        self.callback = callback
+        self.timeout = timeout
+        self.keep = keep
+        self.expected_rc = expected_rc
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.name = name or " | ".join(commands)
+        self.procs = []
+        self.output = []
+        self.fed = 0
+        self.cancelled = None
+        self.feed_error = None
+        self.threads = []
+        self.timer = None
+    
+    def start(self):
+        process_slots.acquire()
+        self.started = time.time()
+        logger.info("Command: %s" % self.name)
+        
+        try:
+            r, w = os.pipe()
+            try:
+                for c in self.commands:
+                    last = len(self.procs) == len(self.commands) - 1
+                    self.procs.append(Popen(shlex.split(c), shell=False,
+                            close_fds=True,
+                            stdin=self.procs and self.procs[-1].stdout or PIPE,
+                            stdout=last and w or PIPE, stderr=w))
+                    ## Only the consumer may hold the read end, or
+                    ## SIGPIPE never fires
+                    if len(self.procs) > 1:
+                        self.procs[-2].stdout.close()
+            finally:
+                os.close(w)
+        except:
+            os.close(r)
+            self.__kill()
+            process_slots.release()
+            raise
+        
+        with self.lock:
+            self.running.add(self)
+        
+        self.threads = [threading.Thread(target=self.__read, args=(r,)),
+                        threading.Thread(target=self.__feed)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+        
+        if self.timeout:
+            self.timer = threading.Timer(self.timeout, self.cancel,
+                                         ("timed out after %ss" %
+                                          self.timeout,))
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+    
+    def wait(self):
+        """Reap all commands, returns the output"""
+        
+        try:
+            for p in self.procs:
+                p.wait()
+            for t in self.threads:
+                t.join()
+            
+            output = "".join(self.output)
+            if self.feed_error:
+                raise self.feed_error[0], self.feed_error[1], \
+                      self.feed_error[2]
+            if self.cancelled:
+                raise Exception("%s: %s" % (self.name, self.cancelled))
+            if [p for p in self.procs if p.returncode != self.expected_rc]:
+                logger.error("%s failed:\n%s" % (self.name, output))
+                raise Exception(output)
+            return output
+        finally:
+            if self.timer:
+                self.timer.cancel()
+            with self.lock:
+                if self in self.running:
+                    self.running.discard(self)
+                    process_slots.release()
+            rcs = [p.returncode for p in self.procs]
+            timeline.record("command", self.name, self.started,
+                            rc=([rc for rc in rcs if rc] + rcs + [None])[0],
+                            size=self.fed or sum(map(len, self.output)))
+    
+    def run(self):
+        return self.start().wait()
+    
+    def cancel(self, reason="cancelled"):
+        """Kill all commands, wait() raises"""
+        
+        self.cancelled = reason
+        logger.warning("%s: %s" % (self.name, reason))
+        self.__kill()
+    
+    @classmethod
+    def cancel_all(cls, reason="cancelled"):
+        with cls.lock:
+            running = list(cls.running)
+        for p in running:
+            p.cancel(reason)
+    
+    def __kill(self):
+        for p in self.procs:
+            if p.poll() is None:
+                try:
+                    p.kill()
+                except OSError:
+                    pass
+    
+    def __feed(self):
+        """Write input to STDIN of the first command"""
+        
+        stdin = self.procs[0].stdin
+        try:
+            if hasattr(self.input, 'read'):
+                while True:
+                    chunk = self.input.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    stdin.write(chunk)
+                    self.fed += len(chunk)
+                    if self.progress:
+                        self.progress(self.fed)
+            elif self.input:
+                stdin.write(self.input)
+                self.fed = len(self.input)
+        except IOError, e:
+            ## EPIPE: the consumer died, its output tells why
+            if e.errno != errno.EPIPE:
+                self.feed_error = sys.exc_info()
+                self.__kill()
+        except:
+            self.feed_error = sys.exc_info()
+            self.__kill()
+        
+        try:
+            stdin.close()
+        except IOError:
+            pass
+    
+    def __read(self, fd):
+        """Collect, log and report the output line by line"""
+        
+        rest = ""
+        kept = 0
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            
+            self.output.append(data)
+            kept += len(data)
+            if self.keep and kept > 2 * self.keep:
+                self.output = ["".join(self.output)[-self.keep:]]
+                kept = self.keep
+            
+            lines = LINE_END.split(rest + data)
+            rest = lines.pop()
+            self.__lines(lines)
+        os.close(fd)
+        self.__lines([rest])
+    
+    def __lines(self, lines):
+        for line in lines:
+            if not line.strip():
+                continue
+            logger.info("[%d] %s" % (self.procs[-1].pid, line))
+            if self.callback:
+                try:
+                    self.callback(line)
+                except Exception, e:
+                    logger.error("Output callback of %s failed: %s" %
+                                 (self.name, e))
+
+
+def execute(command, input=None, expected_rc=0, timeout=None,
+            callback=None):
     """Run commands and return the result back to the caller"""
     
-    try:
-        logger.info("Command: %s" % command)
-        proc = Popen(command.split(), shell=False, close_fds=True, stdin=PIPE,
-                     stdout=PIPE, stderr=STDOUT)
-        stdout_value, stderr_value = proc.communicate(input=input)
-        
-        if proc.returncode != expected_rc:
-            logger.error(stdout_value)
-            raise Exception(stdout_value)
-        else:
-            logger.info(stdout_value)
-            return stdout_value
-    except:
-        raise
+    return Process(command, input=input, expected_rc=expected_rc,
+                   timeout=timeout, callback=callback).run()
 
 
 def execute_pipe(command1, command2, expected_rc=0):
     """Run commands and return the result back to the caller"""
     
+    return Process([command1, command2], expected_rc=expected_rc).run()
+
+
+def execute_stream(source, command, chunk_size=CHUNK_SIZE, expected_rc=0,
+                   callback=None, progress=None):
+    """Feed a file-like source into the STDIN of command chunk by chunk,
+    returns the number of bytes fed.
+    
+    command may also be a list of commands which are chained with pipes,
+    e.g. a decompressor in front of tar.
+    """
+    
+    if isinstance(command, basestring):
+        command = [command]
+    
+    p = Process(command, input=source, chunk_size=chunk_size,
+                expected_rc=expected_rc, callback=callback, keep=OUTPUT_TAIL,
+                progress=progress, name="<stream> | %s" % " | ".join(command))
+    p.run()
+    logger.info("%d bytes streamed into %s" % (p.fed, p.name))
+    return p.fed
+
+
+def parse_size(size):
+    """Convert sizes like 500M or 20G to bytes"""
+    
+    if size is None or isinstance(size, (int, long)):
+        return size
+    
+    exp_map = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = str(size).strip().upper()
+    if size[-1] in exp_map:
+        return int(float(size[:-1]) * exp_map[size[-1]])
+    return int(size)
+
+
+def partition_name(disk, number):
+    """Device name of a partition (/dev/sda1, /dev/loop0p1, /dev/md0p1)"""
+    
+    if disk[-1].isdigit():
+        return "%sp%d" % (disk, number)
+    return "%s%d" % (disk, number)
+
+
+def find_binary(name):
+    """Return the full path of an executable or None"""
+    
+    path = os.environ.get('PATH', '').split(os.pathsep)
+    for d in path + ['/bin', '/sbin', '/usr/bin', '/usr/sbin']:
+        candidate = os.path.join(d, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def run_parallel(func, items, workers=None):
+    """Run func(item) for every item in a pool of threads
+    
+    Returns a dict item => exception of all failed items (empty if
+    everything went fine). workers limits the pool size (default: one
+    thread per item).
+    """
+    
+    queue = Queue.Queue()
+    errors = {}
+    lock = threading.Lock()
+    
+    for item in items:
+        queue.put(item)
+    
+    def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                func(item)
+            except Exception, e:
+                logger.error("%s(%s) failed: %s" %
+                             (getattr(func, '__name__', func), item, e))
+                with lock:
+                    errors[item] = e
+    
+    threads = [threading.Thread(target=worker)
+               for i in range(min(workers or len(items), len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    return errors
+
+
+def run_graph(steps, func, workers=None):
+    """Run func(name) for every (name, dependencies) tuple in steps
+    
+    A step is started as soon as all of its dependencies are done, with
+    at most workers steps at once (default: no limit). workers=1 runs the
+    steps inline in the given order. The first failure stops scheduling
+    further steps and is re-raised once the running steps are finished.
+    """
+    
+    names = [s[0] for s in steps]
+    deps = dict(steps)
+    
+    for name in names:
+        for d in deps[name]:
+            if d not in deps:
+                raise Exception("Step %s depends on unknown step %s" %
+                                (name, d))
+    
+    if workers == 1:
+        for i, name in enumerate(names):
+            for d in deps[name]:
+                if d not in names[:i]:
+                    raise Exception("Step %s runs before its dependency %s"
+                                    % (name, d))
+            func(name)
+        return
+    
+    done = set()
+    running = set()
+    failed = []
+    cond = threading.Condition()
+    
+    def work(name):
+        exc = None
+        try:
+            func(name)
+        except:
+            exc = sys.exc_info()
+        with cond:
+            running.discard(name)
+            if exc:
+                failed.append(exc)
+            else:
+                done.add(name)
+            cond.notify()
+    
+    with cond:
+        while True:
+            if failed and not running:
+                raise failed[0][0], failed[0][1], failed[0][2]
+            if len(done) == len(names):
+                return
+            
+            ready = []
+            if not failed:
+                ready = [n for n in names if n not in done and
+                         n not in running and
+                         not [d for d in deps[n] if d not in done]]
+            if not ready and not running:
+                raise Exception("Circular step dependencies: %s" %
+                                ", ".join([n for n in names if n not in done]))
+            
+            for name in ready[:(workers or len(names)) - len(running)]:
+                running.add(name)
+                threading.Thread(target=work, args=(name,)).start()
+            cond.wait()
+
+
+def mount_order(mounts):
+    """Group mount points by their depth in the mount tree
+    
+    The parent of a mount point is the longest other mount point it is
+    located in, so ['/usr/local', '/', '/var', '/usr'] results in
+    [['/'], ['/usr', '/var'], ['/usr/local']]. Every group only needs the
+    groups before it to be mounted.
+    """
+    
+    depth = {}
+    
+    def get_depth(m):
+        if m not in depth:
+            parents = [p for p in mounts if p != m and
+                       m.startswith(p.rstrip('/') + '/')]
+            if parents:
+                depth[m] = get_depth(max(parents, key=len)) + 1
+            else:
+                depth[m] = 0
+        return depth[m]
+    
+    levels = []
+    for m in sorted(mounts):
+        d = get_depth(m)
+        while len(levels) <= d:
+            levels.append([])
+        levels[d].append(m)
+    
+    return levels
+
+
+def mountpoints():
+    """Everything currently mounted"""
+    
+    return [l.split()[1] for l in open('/proc/mounts')]
+
+
+def config_digest(config, sections, *digests):
+    """sha256 of config sections (dotted paths like global.image) and
+    other digests"""
+    
+    h = hashlib.sha256()
+    for section in sections:
+        value = config
+        for key in section.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        h.update("%s=%s\n" % (section, json.dumps(value, sort_keys=True,
+                                                  default=str)))
+    for d in digests:
+        h.update(d)
+    return h.hexdigest()
+
+
+##******************************
+## Disk wiping
+##******************************
+
+WIPE_BLOCK = 1024 * 1024
+WIPE_SIZE = 5 * WIPE_BLOCK
+MD_RESERVED = 64 * 1024
+BLKDISCARD = 0x1277
+
+
+def device_size(dev):
+    """Size of a block device or file in bytes"""
+    
+    fd = os.open(dev, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def zero_range(dev, offset, length, block=WIPE_BLOCK):
+    """Overwrite length bytes at offset with zeros (block sized writes)"""
+    
+    buf = "\0" * block
+    fd = os.open(dev, os.O_WRONLY)
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while length > 0:
+            length -= os.write(fd, buf[:min(block, length)])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def signature_ranges(size, head=WIPE_BLOCK):
+    """(offset, length) of all areas holding known signatures
+    
+    The head covers partition tables, LVM labels, md 1.1/1.2 and all
+    filesystem superblocks. The tail starts at the md 0.90 superblock
+    (last 64K aligned 64K block) and covers md 1.0 and the GPT backup.
+    """
+    
+    tail = max((size & ~(MD_RESERVED - 1)) - MD_RESERVED, 0)
+    if tail <= head:
+        return [(0, size)]
+    return [(0, head), (tail, size - tail)]
+
+
+def wipe_urandom(dev):
+    """Legacy wipe: 5M of random data at the start of the device"""
+    
+    execute("/bin/dd if=/dev/urandom of=%s bs=5k count=1024" % dev)
+
+
+def wipe_zero(dev):
+    """Zero 5M at the start and everything from the md 0.90 superblock on"""
+    
+    for offset, length in signature_ranges(device_size(dev), WIPE_SIZE):
+        zero_range(dev, offset, length)
+
+
+def wipe_signatures(dev):
+    """Zero only the areas holding known signatures"""
+    
+    for offset, length in signature_ranges(device_size(dev)):
+        zero_range(dev, offset, length)
+
+
+def wipe_discard(dev):
+    """Discard the whole device (if supported) and zero the signatures"""
+    
+    size = device_size(dev)
+    fd = os.open(dev, os.O_WRONLY)
     try:
-        logger.info("Command: %s | %s" % (command1, command2))
-        out = Popen(command1.split(), shell=False, stdin=PIPE, stdout=PIPE,
-                     stderr=STDOUT)
-        proc = Popen(command2.split(), shell=False, stdin=out.stdout,
-                     stdout=PIPE, stderr=STDOUT)
-        stdout_value, stderr_value = proc.communicate()
-        
-        if proc.returncode != expected_rc:
-            logger.error(stdout_value)
-            print(stdout_value)
-            
-            raise Exception(stdout_value)
+        fcntl.ioctl(fd, BLKDISCARD, struct.pack('QQ', 0, size))
+    except IOError, e:
+        logger.info("BLKDISCARD not supported on %s: %s" % (dev, e))
+    finally:
+        os.close(fd)
+    
+    ## Discarded blocks are not guaranteed to read back as zeros
+    wipe_signatures(dev)
+
+
+## diskmgmt.wipe => wipe function
+WIPERS = {'urandom': wipe_urandom,
+          'zero': wipe_zero,
+          'signatures': wipe_signatures,
+          'discard': wipe_discard,
+         }
+
+
+##******************************
+## Images
+##******************************
+
+## Image suffix => compression
+COMPRESSION = (('.tar.bz2', 'bz2'), ('.tbz2', 'bz2'), ('.tbz', 'bz2'),
+               ('.tar.gz', 'gz'), ('.tgz', 'gz'),
+               ('.tar.xz', 'xz'), ('.txz', 'xz'),
+               ('.tar.zst', 'zst'), ('.tzst', 'zst'),
+               ('.tar', None),
+               ('.bz2', 'bz2'), ('.gz', 'gz'), ('.xz', 'xz'), ('.zst', 'zst'),
+              )
+
+## Decompressors in order of preference (multi-core first)
+DECOMPRESSORS = {'bz2': ('lbzip2 -dc', 'pbzip2 -dc', 'bzip2 -dc'),
+                 'gz': ('pigz -dc', 'gzip -dc'),
+                 'xz': ('xz -T0 -dc',),
+                 'zst': ('zstd -T0 -dc',),
+                }
+
+## tar built-in fallback if no decompressor binary is available
+## zstd has no short option (GNU tar >= 1.31)
+TAR_FLAGS = {'bz2': '-j', 'gz': '-z', 'xz': '-J', 'zst': '--zstd', None: ''}
+
+
+def compression_of(image, default='bz2'):
+    """Guess the compression of an image by its suffix"""
+    
+    for suffix, compression in COMPRESSION:
+        if image.endswith(suffix):
+            return compression
+    return default
+
+
+def find_decompressor(compression, preferred=None):
+    """Return the decompressor command (full path + args) or None
+    
+    preferred is either a binary name from DECOMPRESSORS ("pbzip2") or a
+    full command ("pbzip2 -p16 -dc"). "tar" forces the tar built-in. A
+    preferred tool not listed for this compression is ignored.
+    """
+    
+    if preferred == "tar":
+        return None
+    
+    candidates = list(DECOMPRESSORS.get(compression, ()))
+    if preferred:
+        known = [c for c in candidates
+                 if c.split()[0] == preferred.split()[0]]
+        if not known:
+            logger.warning("%s can't decompress %s, using the default"
+                           % (preferred, compression))
+        elif len(preferred.split()) > 1:
+            candidates.insert(0, preferred)
         else:
-            logger.info(stdout_value)
-            return stdout_value
+            candidates = known + candidates
+    
+    for c in candidates:
+        binary = find_binary(c.split()[0])
+        if binary:
+            return " ".join([binary] + c.split()[1:])
+    return None
+
+
+def libc_function(name, restype, *argtypes):
+    """Function of the C library (via ctypes) or None"""
+    
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6",
+                           use_errno=True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    
+    function.restype = restype
+    function.argtypes = argtypes
+    
+    def call(*args):
+        result = function(*args)
+        if result < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return result
+    return call
+
+
+def libc_splice():
+    call = libc_function('splice', ctypes.c_ssize_t, ctypes.c_int,
+                         ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                         ctypes.c_size_t, ctypes.c_uint)
+    if not call:
+        return None
+    
+    def splice(src, dst, count, offset_src=None, offset_dst=None, flags=0):
+        return call(src, None, dst, None, count, flags)
+    return splice
+
+
+def libc_sendfile():
+    call = libc_function('sendfile64', ctypes.c_ssize_t, ctypes.c_int,
+                         ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                         ctypes.c_size_t)
+    if not call:
+        return None
+    
+    def sendfile(out_fd, in_fd, offset, count):
+        return call(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)),
+                    count)
+    return sendfile
+
+
+## Kernel side copies (os.splice is new in Python 3.10)
+splice = getattr(os, 'splice', None) or libc_splice()
+sendfile = getattr(os, 'sendfile', None) or libc_sendfile()
+
+
+def set_pipe_size(fd, size):
+    """Grow a pipe to size (less syscalls per MB), at most to the limit
+    of unprivileged users, best effort"""
+    
+    try:
+        size = min(size, int(open("/proc/sys/fs/pipe-max-size").read()))
+    except (IOError, ValueError):
+        pass
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except IOError:
+        pass
+
+
+def stream_fd(reader):
+    """(fd, size or None, timeout) the kernel can read the data of reader
+    from, None if reader has data in Python buffers or must see it
+    (checksums, cache, chunks)"""
+    
+    if isinstance(reader, ResponseStream):
+        r = reader.response
+        ## Headers are read unbuffered, the body is still in the socket
+        if r.chunked or r.length is None or r.fp is None or \
+           getattr(r.fp, '_rbuf', None) and r.fp._rbuf.tell():
+            return None
+        return r.fp.fileno(), r.length, reader.fetcher.timeout
+    if isinstance(reader, file):
+        return reader.fileno(), None, None
+    return None
+
+
+def kernel_copy(src, dst, size=None, block_size=IMAGE_BLOCK, timeout=None):
+    """Move size bytes (all if None) from src to dst without copying them
+    to user space: sendfile from files, splice from pipes and (through a
+    pipe) sockets. Returns the bytes moved."""
+    
+    total = 0
+    mode = os.fstat(src).st_mode
+    count = lambda: size is None and block_size or \
+                    min(block_size, size - total)
+    
+    if stat.S_ISREG(mode):
+        offset = os.lseek(src, 0, os.SEEK_CUR)
+        while size is None or total < size:
+            n = sendfile(dst, src, offset + total, count())
+            if not n:
+                break
+            total += n
+        os.lseek(src, offset + total, os.SEEK_SET)
+        return total
+    
+    if stat.S_ISFIFO(mode):
+        while size is None or total < size:
+            n = splice(src, dst, count(), flags=SPLICE_F_MOVE | SPLICE_F_MORE)
+            if not n:
+                break
+            total += n
+        return total
+    
+    r, w = os.pipe()
+    try:
+        set_pipe_size(w, block_size)
+        while size is None or total < size:
+            try:
+                n = splice(src, w, count(), flags=SPLICE_F_MOVE |
+                                                  SPLICE_F_MORE)
+            except OSError, e:
+                ## Sockets with a timeout are non-blocking
+                if e.errno != errno.EAGAIN:
+                    raise
+                if not select.select([src], [], [], timeout)[0]:
+                    raise socket.timeout("No data for %s seconds" % timeout)
+                continue
+            if not n:
+                break
+            left = n
+            while left:
+                left -= splice(r, dst, left, flags=SPLICE_F_MOVE |
+                                                   SPLICE_F_MORE)
+            total += n
+    finally:
+        os.close(r)
+        os.close(w)
+    return total
+
+
+def buffered_copy(reader, fd, sparse=False, block_size=IMAGE_BLOCK):
+    """Copy reader to fd through a single reused buffer (page aligned, as
+    it is mmap'ed), readinto() where reader has it. Returns the bytes."""
+    
+    buf = mmap.mmap(-1, block_size)
+    zero = "\0" * block_size
+    readinto = getattr(reader, 'readinto', None)
+    total = 0
+    while True:
+        if readinto:
+            n = readinto(buf)
+            block = buffer(buf, 0, n)
+        else:
+            block = buffer(reader.read(block_size))
+            n = len(block)
+        if not n:
+            break
+        if sparse and block == buffer(zero, 0, n):
+            os.lseek(fd, n, os.SEEK_CUR)
+        else:
+            written = 0
+            while written < n:
+                written += os.write(fd, buffer(block, written))
+        total += n
+    buf.close()
+    return total
+
+
+def write_image(source, dev, decompressor=None, sparse=False,
+                block_size=IMAGE_BLOCK, zero_copy=True):
+    """Write a raw filesystem image from source to dev
+    
+    The image is written with large sequential writes. decompressor is a
+    command (see find_decompressor) the data is piped through. With sparse
+    all-zero blocks are skipped, only use this for regular files or
+    devices which are known to be zeroed. With zero_copy the data goes
+    from the decompressor, the HTTP socket or the image file to dev in the
+    kernel where possible (see kernel_copy). Returns the bytes written.
+    """
+    
+    start = time.time()
+    
+    fd = os.open(dev, os.O_WRONLY)
+    proc = None
+    feeder_errors = []
+    if decompressor:
+        errors = tempfile.TemporaryFile()
+        proc = Popen(decompressor.split(), shell=False, close_fds=True,
+                     stdin=PIPE, stdout=PIPE, stderr=errors)
+        set_pipe_size(proc.stdout.fileno(), block_size)
+        
+        def feed():
+            try:
+                while True:
+                    chunk = source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    proc.stdin.write(chunk)
+            except Exception, e:
+                feeder_errors.append(e)
+            finally:
+                try:
+                    proc.stdin.close()
+                except IOError:
+                    pass
+        
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        reader = proc.stdout
+    else:
+        reader = source
+    
+    kernel = zero_copy and not sparse and splice and sendfile and \
+             stream_fd(reader)
+    logger.info("Writing raw image to %s (decompressor: %s, sparse: %s, "
+                "zero copy: %s)" % (dev, decompressor, sparse, bool(kernel)))
+    try:
+        if kernel:
+            total = kernel_copy(kernel[0], fd, kernel[1], block_size,
+                                kernel[2])
+            if kernel[1] is not None and total != kernel[1]:
+                raise UliException("Image ended after %d of %d bytes" %
+                                   (total, kernel[1]))
+            if isinstance(reader, ResponseStream):
+                ## All of the body is read, the connection can be reused
+                reader.response.length = 0
+                reader.response.close()
+        else:
+            total = buffered_copy(reader, fd, sparse, block_size)
+        
+        ## Skipped zero blocks at the end of a file still count
+        if sparse and os.path.isfile(dev) and os.fstat(fd).st_size < total:
+            os.ftruncate(fd, total)
+        os.fsync(fd)
     except:
+        if proc:
+            proc.kill()
         raise
+    finally:
+        os.close(fd)
+        if proc:
+            feeder.join()
+            proc.wait()
+    
+    if proc and proc.returncode != 0:
+        errors.seek(0)
+        raise Exception("%s failed: %s" % (decompressor, errors.read()))
+    if feeder_errors:
+        raise feeder_errors[0]
+    
+    logger.info("Wrote %d bytes to %s" % (total, dev))
+    timeline.record("command", "<image> > %s" % dev, start, rc=0, size=total)
+    return total
+
+
+## Gear table of the content defined chunking, fixed for all time: the
+## chunks of old and new manifests only match with the same table
+GEAR = dict([(chr(i), int(hashlib.md5(chr(i)).hexdigest()[:8], 16))
+             for i in range(256)])
+GEAR_BYTES = [GEAR[chr(i)] for i in range(256)]
+
+
+def cdc_cut(data, min_size, max_size, mask):
+    """Length of the next content defined chunk at the start of data"""
+    
+    if len(data) <= min_size:
+        return len(data)
+    
+    ## The gear hash only depends on the last 32 bytes, so the cuts are
+    ## found again after an insert or delete. mask only tests bits < 32,
+    ## so h is cut to 32 bits every 29 bytes only (before it outgrows a
+    ## machine int) instead of every byte.
+    gear = GEAR_BYTES
+    end = min(len(data), max_size)
+    h = 0
+    i = min_size
+    while i < end:
+        h &= 0xffffffff
+        for b in bytearray(data[i:min(i + 29, end)]):
+            h = (h << 1) + gear[b]
+            i += 1
+            if not h & mask:
+                return i
+    return i
+
+
+def cdc_chunks(f, avg_size=CDC_AVG):
+    """Split the file f into content defined chunks (gear rolling hash),
+    between avg_size/4 and avg_size*4 bytes long
+    
+    The hash runs byte by byte in Python, about 0.1 s per MB past the
+    minimum chunk size: minutes for an image of several GB.
+    """
+    
+    min_size, max_size = avg_size / 4, avg_size * 4
+    bits = max(int(round(math.log(avg_size - min_size, 2))), 1)
+    mask = ((1 << bits) - 1) << (32 - bits)
+    
+    buf = ""
+    eof = False
+    while True:
+        if not eof and len(buf) < max_size:
+            data = f.read(max_size)
+            eof = not data
+            buf += data
+            continue
+        if not buf:
+            break
+        cut = cdc_cut(buf, min_size, max_size, mask)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+def make_manifest(path, chunk_size=None, cdc=False):
+    """Build the chunk manifest of an image: total size and the sha256
+    and size of every chunk (in order)
+    
+    With cdc the chunk boundaries depend on the content (chunk_size is
+    the average), so a new version of an image shares most chunks with
+    the old one and installers only fetch the chunks that changed.
+    """
+    
+    chunks = []
+    size = 0
+    with open(path, 'rb') as f:
+        if cdc:
+            blocks = cdc_chunks(f, chunk_size or CDC_AVG)
+        else:
+            blocks = iter(lambda: f.read(chunk_size or CHUNK_IMAGE), "")
+        for data in blocks:
+            chunks.append([hashlib.sha256(data).hexdigest(), len(data)])
+            size += len(data)
+    
+    manifest = {'size': size, 'chunks': chunks}
+    if cdc:
+        manifest['chunking'] = "cdc"
+    return manifest
+
+
+def fetch_range(fetcher, url, offset, size):
+    """Get size bytes at offset of url via range request"""
+    
+    r = fetcher.open(url, headers={'Range': 'bytes=%d-%d' %
+                                   (offset, offset + size - 1)})
+    ## A backend without range support answers with the whole image:
+    ## only its start is read, release() drops the connection of a
+    ## response not read completely
+    if r.status == 206:
+        data = r.read()
+    elif r.status == 200 and not offset:
+        data = r.read(size)
+    else:
+        data = None
+    fetcher.release(r)
+    if data is None:
+        raise UliException("Range request to %s failed: %d %s" %
+                           (url, r.status, r.reason))
+    return data[:size]
+
+
+def parse_checksum(algorithm, text):
+    """(algorithm, hex digest) of a checksum file"""
+    
+    fields = text.split()
+    if not fields or not re.match(r'^[0-9a-fA-F]+$', fields[0]):
+        raise UliException("Invalid %s checksum file" % algorithm)
+    return algorithm, fields[0].lower()
+
+
+def fetch_checksum(fetcher, url):
+    """Checksum of url from the backend (see CHECKSUMS) or None"""
+    
+    for ext, algorithm in CHECKSUMS:
+        r = fetcher.open("%s.%s" % (url, ext))
+        data = r.read()
+        fetcher.release(r)
+        if r.status == 200:
+            return parse_checksum(algorithm, data)
+    return None
+
+
+def read_checksum(path):
+    """Checksum of a local (NFS) file or None"""
+    
+    for ext, algorithm in CHECKSUMS:
+        if os.path.exists("%s.%s" % (path, ext)):
+            return parse_checksum(algorithm,
+                                  open("%s.%s" % (path, ext)).read())
+    return None
+
+
+def file_digest(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(CHUNK_SIZE), ""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class VerifyingReader:
+    """File-like wrapper hashing everything read from source, so an image
+    is verified in the same pass that installs it
+    
+    A held CacheTee source is committed to the cache once the image is
+    verified. On a mismatch key is removed from cache, so a bad image is
+    never served from there.
+    """
+    
+    def __init__(self, source, checksum, name, cache=None, key=None):
+        self.source = source
+        self.algorithm, self.expected = checksum
+        self.name = name
+        self.cache = cache
+        self.key = key
+        self.digest = hashlib.new(self.algorithm)
+    
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.digest.update(data)
+        return data
+    
+    def verify(self):
+        """Raise UliException if the data doesn't match the checksum"""
+        
+        ## Whatever the consumer didn't need (tar stops at its end
+        ## marker) still counts
+        for data in iter(lambda: self.read(CHUNK_SIZE), ""):
+            pass
+        if self.digest.hexdigest() != self.expected:
+            if self.cache and self.key:
+                self.cache.remove(self.key)
+            raise UliException("%s checksum mismatch for %s" %
+                               (self.algorithm, self.name))
+        logger.info("%s checksum of %s ok" % (self.algorithm, self.name))
+        if isinstance(self.source, CacheTee):
+            self.source.commit()
+    
+    def close(self):
+        self.source.close()
+
+
+##******************************
+## Config loading
+##******************************
+
+class ConfigLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    """Safe (libyaml if available) loader that still knows tuples"""
+    
+    pass
+
+ConfigLoader.add_constructor(u'tag:yaml.org,2002:python/tuple',
+                             lambda loader, node:
+                                 tuple(loader.construct_sequence(node)))
+
+## sha256 of the YAML => marshalled config
+_configs = {}
+
+
+def load_config(data):
+    """Parse a YAML config, cached by content in memory and on disk"""
+    
+    digest = hashlib.sha256(data).hexdigest()
+    if digest not in _configs:
+        path = os.path.join(CONFIG_CACHE, "%s.marshal" % digest)
+        try:
+            ## Only trust what we wrote ourselves
+            if os.stat(path).st_uid != os.getuid():
+                raise IOError("%s not owned by us" % path)
+            _configs[digest] = open(path, 'rb').read()
+            return marshal.loads(_configs[digest])
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            _configs.pop(digest, None)
+        
+        config = yaml.load(data, Loader=ConfigLoader)
+        try:
+            _configs[digest] = marshal.dumps(config)
+        except ValueError:
+            ## Something marshal can't do (e.g. dates), just don't cache
+            return config
+        
+        ## Survives the switch to ULI_UPDATE in god.py
+        try:
+            if not os.path.isdir(CONFIG_CACHE):
+                os.makedirs(CONFIG_CACHE)
+            fd, part = tempfile.mkstemp(dir=CONFIG_CACHE)
+            os.write(fd, _configs[digest])
+            os.close(fd)
+            os.rename(part, path)
+        except (IOError, OSError):
+            pass
+    
+    return marshal.loads(_configs[digest])
+
+
+##******************************
+## Config validation
+##******************************
+
+LVM_EXTENT = 4 * 1024 ** 2
+
+
+def lv_size(size):
+    """Bytes of an lvcreate -L size (plain numbers are MB)"""
+    
+    if isinstance(size, (int, long)) or str(size).strip().isdigit():
+        return int(size) * 1024 ** 2
+    return parse_size(size)
+
+
+def normalize_config(config):
+    """Fix up types lost in JSON (partition numbers are int keys)"""
+    
+    partitions = config.get('diskmgmt', {}).get('partitions')
+    if partitions:
+        config['diskmgmt']['partitions'] = dict([(int(p), partitions[p])
+                                                 for p in partitions])
+    return config
+
+
+def validate_config(config):
+    """Return the list of problems of a config (empty if it's fine)"""
+    
+    errors = []
+    if not isinstance(config, dict):
+        return ["Config is not a mapping"]
+    for key in ('global', 'diskmgmt', 'fs'):
+        if not isinstance(config.get(key), dict):
+            errors.append("%s section is missing" % key)
+    if errors:
+        return errors
+    
+    for key in ('hostname', 'domainname'):
+        if not config['global'].get(key):
+            errors.append("global.%s is missing" % key)
+    if config['global'].get('verify') not in (None, True, False):
+        errors.append("global.verify must be true or false")
+    
+    dm = config['diskmgmt']
+    disks = list(dm.get('disks') or [])
+    partitions = dm.get('partitions') or {}
+    if not disks:
+        errors.append("diskmgmt.disks is empty")
+    if not partitions:
+        errors.append("diskmgmt.partitions is empty")
+    if len(partitions) > 4:
+        errors.append("You cannot create more than 4 partitions in U.L.I")
+    if dm.get('type') == "md" and len(disks) != 2:
+        errors.append("md RAID1 needs exactly 2 disks (got %d)" % len(disks))
+    if dm.get('wipe', 'signatures') not in WIPERS:
+        errors.append("Unknown wipe strategy %s" % dm['wipe'])
+    resync = dm.get('resync') or {}
+    if not isinstance(resync, dict):
+        errors.append("diskmgmt.resync is not a mapping")
+    else:
+        for key in ('speed_min', 'speed_max'):
+            if resync.get(key) and not str(resync[key]).isdigit():
+                errors.append("diskmgmt.resync.%s is not a number (KB/s)" %
+                              key)
+    
+    ## Block devices the config creates => size in bytes (None: unknown)
+    devices = {}
+    for i, p in enumerate(sorted(partitions)):
+        part = partitions[p] or {}
+        if 'type' not in part:
+            errors.append("Partition %s has no type" % p)
+        size = part.get('size')
+        if size and not str(size).isdigit():
+            errors.append("Partition %s: size %s is not a number (MB)" %
+                          (p, size))
+            size = None
+        size = size and int(size) * 1024 ** 2
+        if dm.get('type') == "md":
+            devices["/dev/md%d" % (int(p) - 1)] = size
+        else:
+            for d in disks:
+                devices[partition_name(d, i + 1)] = size
+    
+    vgs = (config.get('lvm') or {}).get('vg') or {}
+    for v in sorted(vgs):
+        vg_size = 0
+        for pv in vgs[v].get('pv') or []:
+            if pv not in devices:
+                errors.append("VG %s: PV %s is not defined in diskmgmt" %
+                              (v, pv))
+                vg_size = None
+            elif vg_size is not None and devices[pv] is not None:
+                vg_size += devices[pv]
+            else:
+                vg_size = None
+            devices.pop(pv, None)
+        
+        lvs_size = 0
+        for lv in sorted(vgs[v].get('lv') or {}):
+            try:
+                size = lv_size(vgs[v]['lv'][lv])
+            except (ValueError, TypeError, IndexError):
+                errors.append("LV %s/%s: invalid size %s" %
+                              (v, lv, vgs[v]['lv'][lv]))
+                continue
+            ## lvcreate rounds up to full extents
+            lvs_size += -(-size // LVM_EXTENT) * LVM_EXTENT
+            devices["/dev/%s/%s" % (v, lv)] = size
+        
+        ## One extent for metadata and alignment
+        if vg_size is not None and lvs_size > vg_size - LVM_EXTENT:
+            errors.append("VG %s: LVs need %d MB but the VG has only %d MB" %
+                          (v, lvs_size / 1024 ** 2, vg_size / 1024 ** 2))
+    
+    used = {}
+    for fs in sorted(config['fs']):
+        entry = config['fs'][fs] or {}
+        if not entry.get('dev') or not entry.get('type'):
+            errors.append("fs %s needs dev and type" % fs)
+            continue
+        if entry['dev'] not in devices:
+            errors.append("fs %s: device %s is not defined in diskmgmt/lvm"
+                          % (fs, entry['dev']))
+        if entry['dev'] in used:
+            errors.append("fs %s: device %s is already used by %s" %
+                          (fs, entry['dev'], used[entry['dev']]))
+        used[entry['dev']] = fs
+        if entry['type'] != "swap" and entry['type'] not in MKFS_OPTS and \
+           not entry.get('image'):
+            errors.append("Unsupported filesystem %s for %s" %
+                          (entry['type'], fs))
+        if entry.get('tuning') and entry['tuning'] not in FS_TUNING:
+            errors.append("fs %s: unknown tuning profile %s" %
+                          (fs, entry['tuning']))
+    if "/" not in config['fs']:
+        errors.append("No / filesystem")
+    
+    return errors
+
+
+##******************************
+## md resync
+##******************************
+
+MD_PROGRESS = re.compile(r'(resync|recovery)\s*=\s*([\d.]+)%.*?'
+                         r'finish=(\S+)\s+speed=(\S+)')
+
+
+def md_sysfs(md_id, name):
+    """sysfs attribute of /dev/md<md_id>"""
+    
+    return "/sys/block/md%d/md/%s" % (md_id, name)
+
+
+def write_sysfs(path, value):
+    with open(path, 'w') as f:
+        f.write("%s\n" % value)
+
+
+def md_progress(mdstat=None):
+    """{md: (action, percent, finish, speed)} of the running resyncs"""
+    
+    progress = {}
+    md = None
+    for line in (mdstat or open('/proc/mdstat').read()).splitlines():
+        if re.match(r'^md\d+ :', line):
+            md = line.split()[0]
+        m = MD_PROGRESS.search(line)
+        if md and m:
+            progress[md] = m.groups()
+    return progress
+
+
+class ResyncMonitor(threading.Thread):
+    """Record the progress of md resyncs in the timeline (kind resync)"""
+    
+    def __init__(self, interval=30):
+        threading.Thread.__init__(self, name="resync")
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+    
+    def sample(self):
+        try:
+            progress = md_progress()
+        except IOError:
+            return
+        for md in sorted(progress):
+            timeline.record("resync", md, time.time(),
+                            rc="%s %s%% finish=%s speed=%s" % progress[md])
+    
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+##******************************
+## Command builders
+##******************************
+
+## mkfs options by filesystem type
+MKFS_OPTS = {"ext2": "-F", "ext3": "-F", "ext4": "-F", "reiserfs": "-f",
+             "xfs": "-f"}
+
+## Tuning profiles (fs: tuning) for a fast install: mkfs options, mke2fs
+## extended options and the mount options used while installing. The
+## install() is followed by a remount with the final (fstab) options.
+FS_TUNING = {'fast': {'ext2': {'extended': ["lazy_itable_init=1",
+                                            "nodiscard"],
+                               'install_options': "noatime"},
+                      'ext3': {'extended': ["lazy_itable_init=1",
+                                            "lazy_journal_init=1",
+                                            "nodiscard"],
+                               'install_options': "noatime,data=writeback,"
+                                                  "barrier=0,commit=60"},
+                      'ext4': {'extended': ["lazy_itable_init=1",
+                                            "lazy_journal_init=1",
+                                            "nodiscard"],
+                               'install_options': "noatime,data=writeback,"
+                                                  "barrier=0,commit=60"},
+                      'xfs': {'mkfs': "-K",
+                              'install_options': "noatime,logbufs=8,"
+                                                 "logbsize=256k"},
+                     },
+            }
+
+
+def sfdisk_input(partitions):
+    """sfdisk input (MB units) and the {partition number: type} map"""
+    
+    echo_str = ""
+    p_id = 1
+    p_ids = {}
+    for p in partitions:
+        p_ids[p_id] = partitions[p]['type']
+        echo_str += ",%s\n" % (partitions[p]['size'] or '')
+        p_id += 1
+    if len(partitions) < 4:
+        echo_str += ",\n"
+    echo_str += ";\n"
+    return echo_str, p_ids
+
+
+def mdadm_create_command(md_id, devices, assume_clean=False):
+    """mdadm command creating /dev/md<md_id> as RAID1 of devices
+    
+    assume_clean skips the initial resync (only for fresh or wiped
+    disks, where there is nothing to get out of sync).
+    """
+    
+    return "/sbin/mdadm --create --force --metadata=0.90 --verbose \
+            /dev/md%d --level=1 --auto=yes --raid-devices=2 %s%s" % \
+            (md_id, assume_clean and "--assume-clean " or "",
+             " ".join(devices))
+
+
+def lvm_commands(name, vg):
+    """pvcreate/vgcreate/lvcreate commands of a volume group"""
+    
+    commands = ["/sbin/pvcreate -ff -y %s" % pv for pv in vg['pv']]
+    commands.append("/sbin/vgcreate %s %s" % (name, " ".join(vg['pv'])))
+    for lv in vg['lv']:
+        commands.append("/sbin/lvcreate -n %s -L %s %s" %
+                        (lv, vg['lv'][lv], name))
+    return commands
+
+
+def fs_tuning(fs):
+    """Tuning profile settings of an fs config entry ({} if untuned)"""
+    
+    return FS_TUNING.get(fs.get('tuning'), {}).get(fs['type'], {})
+
+
+def fs_options(fs):
+    """Final (fstab) mount options of an fs config entry"""
+    
+    if fs['type'] == "swap":
+        return fs.get('options', "sw")
+    return fs.get('options', "noatime")
+
+
+def md_geometry(dev):
+    """(chunk size in KB, data disks) of striped md arrays, else None"""
+    
+    m = re.match(r'^/dev/md(\d+)$', dev)
+    if not m:
+        return None
+    
+    md_id = int(m.group(1))
+    try:
+        level = open(md_sysfs(md_id, 'level')).read().strip()
+        chunk = int(open(md_sysfs(md_id, 'chunk_size')).read()) / 1024
+        disks = int(open(md_sysfs(md_id, 'raid_disks')).read())
+    except (IOError, ValueError):
+        return None
+    
+    ## raid1 (all U.L.I. creates itself) has no stripes
+    data = {'raid0': disks, 'raid10': disks / 2, 'raid5': disks - 1,
+            'raid6': disks - 2}.get(level)
+    return chunk and data and (chunk, data) or None
+
+
+def mkfs_command(fs, geometry=None):
+    """mkfs command of an fs config entry
+    
+    Besides the tuning profile, journal_size (MB) and the RAID geometry
+    (stripe_unit in KB and stripe_disks, or geometry as returned by
+    md_geometry) are passed on to mkfs.
+    """
+    
+    tuning = fs_tuning(fs)
+    opts = [MKFS_OPTS[fs['type']]]
+    if tuning.get('mkfs'):
+        opts.append(tuning['mkfs'])
+    extended = list(tuning.get('extended', []))
+    
+    if fs.get('stripe_unit') and fs.get('stripe_disks'):
+        geometry = (int(fs['stripe_unit']), int(fs['stripe_disks']))
+    if geometry and fs['type'].startswith("ext"):
+        ## In 4K blocks
+        stride = max(geometry[0] / 4, 1)
+        extended.append("stride=%d,stripe_width=%d" %
+                        (stride, stride * geometry[1]))
+    elif geometry and fs['type'] == "xfs":
+        opts.append("-d su=%dk,sw=%d" % geometry)
+    
+    if fs.get('journal_size') and fs['type'] in ("ext3", "ext4"):
+        opts.append("-J size=%d" % int(fs['journal_size']))
+    elif fs.get('journal_size') and fs['type'] == "xfs":
+        opts.append("-l size=%dm" % int(fs['journal_size']))
+    
+    if extended and fs['type'].startswith("ext"):
+        opts.append("-E %s" % ",".join(extended))
+    
+    return "/sbin/mkfs.%s %s %s" % (fs['type'], " ".join(opts), fs['dev'])
+
+
+def mount_command(fs, target, options=None):
+    """mount command of an fs config entry"""
+    
+    return "/bin/mount -t %s %s%s %s" % (fs['type'],
+                                         options and "-o %s " % options or "",
+                                         fs['dev'], target)
+
+
+def extract_command(image, root, preferred=None):
+    """(decompressor or None, tar command) to extract image to root
+    
+    Without decompressor the tar command misses the file argument ("-"
+    or the image path).
+    """
+    
+    compression = compression_of(image)
+    decompressor = find_decompressor(compression, preferred)
+    if decompressor:
+        return decompressor, "/bin/tar -C %s -xSpf -" % root
+    return None, " ".join([c for c in ("/bin/tar", "-C", root,
+                                       TAR_FLAGS[compression], "-xSpf") if c])
+
+
+def grub_input(index, disk):
+    """grub batch input to set up the boot loader on (hd<index>)"""
+    
+    return "find /boot/grub/stage1\ndevice (hd%d) %s\nroot \
+                          (hd%d,0)\nsetup (hd%d)\nquit\n" % \
+           (index, disk, index, index)
 
 
 ##******************************
@@ -92,47 +1564,1256 @@ class UliException(Exception):
         return repr(self.err)
 
 
+class Timeline:
+    """Wall-clock timings of install steps and commands
+    
+    Every event records kind (step, command, ...), name, start offset and
+    duration in seconds, return code / status and the output size.
+    """
+    
+    fields = ('kind', 'name', 'start', 'duration', 'rc', 'size', 'thread')
+    
+    def __init__(self):
+        self.started = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+        ## Called with every new event (e.g. Reporter.add)
+        self.listeners = []
+    
+    def record(self, kind, name, start, rc=None, size=None):
+        """Add an event which started at start (time.time()) and ends now"""
+        
+        event = {'kind': kind, 'name': name,
+                 'start': round(start - self.started, 3),
+                 'duration': round(time.time() - start, 3),
+                 'rc': rc, 'size': size,
+                 'thread': threading.current_thread().name}
+        with self.lock:
+            self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+        return event
+    
+    def summary(self, top=5):
+        """Table of the step durations and the slowest commands"""
+        
+        steps = [e for e in self.events if e['kind'] == "step"]
+        total = time.time() - self.started
+        
+        lines = ["%-24s %10s %6s  %s" % ("Step", "Seconds", "%", "Result")]
+        for e in steps:
+            lines.append("%-24s %10.1f %6.1f  %s" %
+                         (e['name'], e['duration'],
+                          100 * e['duration'] / (total or 1), e['rc']))
+        lines.append("%-24s %10.1f" % ("Total", total))
+        
+        commands = sorted([e for e in self.events if e['kind'] == "command"],
+                          key=lambda e: e['duration'], reverse=True)[:top]
+        if commands:
+            lines.append("")
+            lines.append("Slowest commands:")
+            for e in commands:
+                lines.append("%10.1fs  %s" % (e['duration'], e['name'][:60]))
+        return "\n".join(lines)
+    
+    def write(self, base):
+        """Write the timeline as <base>.json and <base>.csv"""
+        
+        with self.lock:
+            events = list(self.events)
+        
+        with open("%s.json" % base, 'w') as f:
+            json.dump({'started': self.started, 'events': events}, f,
+                      indent=1)
+        
+        with open("%s.csv" % base, 'w') as f:
+            w = csv.writer(f)
+            w.writerow(self.fields)
+            for e in events:
+                w.writerow([e[field] for field in self.fields])
+
+
+timeline = Timeline()
+
+
+class Journal:
+    """Checkpoints of completed install steps (step => config digest)
+    
+    Kept in tmpfs, so a rerun after a failure in the same boot can skip
+    the steps that are already done for the same config.
+    """
+    
+    def __init__(self, path=JOURNAL):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            self.steps = json.load(open(path))
+        except (IOError, ValueError):
+            self.steps = {}
+    
+    def done(self, name, digest):
+        """Is the step done for this digest?"""
+        
+        return self.steps.get(name) == digest
+    
+    def add(self, name, digest):
+        with self.lock:
+            self.steps[name] = digest
+            self.__write()
+    
+    def invalidate(self, names):
+        with self.lock:
+            for name in names:
+                self.steps.pop(name, None)
+            self.__write()
+    
+    def clear(self):
+        with self.lock:
+            self.steps = {}
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+    
+    def __write(self):
+        try:
+            with open("%s.part" % self.path, 'w') as f:
+                json.dump(self.steps, f)
+            os.rename("%s.part" % self.path, self.path)
+        except (IOError, OSError), e:
+            logger.error("Failed to write journal %s: %s" % (self.path, e))
+
+
+class Fetcher:
+    """HTTP client with keep-alive connections and conditional GETs
+    
+    A single GET serves as probe and download. Validators (ETag and
+    Last-Modified) of downloaded files are kept in <target>.meta, so a
+    file which didn't change on the backend is not transferred again.
+    """
+    
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+    
+    def __connection(self, key):
+        """Get an idle connection to (host, port) or open a new one"""
+        
+        with self.lock:
+            if self.idle.get(key):
+                return self.idle[key].pop()
+        return httplib.HTTPConnection(key[0], key[1], timeout=self.timeout)
+    
+    def open(self, url, method="GET", headers=None, body=None):
+        """Send a request and return the response (with .url set)
+        
+        Hand the response back with release() once it has been read
+        completely, so its connection can be reused.
+        """
+        
+        parts = urlparse.urlsplit(url)
+        key = (parts.hostname, parts.port or 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        
+        ## A kept-alive connection might have been closed by the server
+        for retry in (False, True):
+            conn = self.__connection(key)
+            try:
+                conn.request(method, path, body, headers=headers or {})
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if retry:
+                    raise
+        
+        logger.info("HTTP %s %s => %d" % (method, url, response.status))
+        response.url = url
+        response.key = key
+        response.conn = conn
+        return response
+    
+    def release(self, response):
+        """Return the connection of a response to the pool"""
+        
+        if response.isclosed() and not response.will_close:
+            with self.lock:
+                self.idle.setdefault(response.key, []).append(response.conn)
+        else:
+            response.conn.close()
+    
+    def close(self):
+        """Close all idle connections"""
+        
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+    
+    def fetch(self, url, target, verify=False):
+        """Download url to target, False if the backend doesn't have it
+        
+        The digests of the download are computed on the way to disk. With
+        verify they are compared to the checksum file of url (if the
+        backend has one), a mismatch raises UliException.
+        """
+        
+        meta_file = "%s.meta" % target
+        meta = {}
+        headers = {}
+        if os.path.exists(target) and os.path.exists(meta_file):
+            try:
+                meta = json.load(open(meta_file))
+            except ValueError:
+                meta = {}
+            if meta.get('url') == url:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+        
+        response = self.open(url, headers=headers)
+        try:
+            if response.status == 304:
+                response.read()
+            elif response.status != 200:
+                response.read()
+                return False
+            else:
+                digests = [(a, hashlib.new(a)) for e, a in CHECKSUMS]
+                with open("%s.part" % target, 'wb') as f:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        for a, d in digests:
+                            d.update(chunk)
+                os.rename("%s.part" % target, target)
+                
+                meta = {'url': url,
+                        'etag': response.getheader('etag'),
+                        'last_modified': response.getheader('last-modified'),
+                        'digests': dict([(a, d.hexdigest())
+                                         for a, d in digests])}
+                with open(meta_file, 'w') as f:
+                    json.dump(meta, f)
+        finally:
+            self.release(response)
+        
+        if verify:
+            self.__verify(url, target, meta.get('digests') or {})
+        return os.path.exists(target)
+    
+    def __verify(self, url, target, digests):
+        checksum = fetch_checksum(self, url)
+        if not checksum:
+            return
+        
+        algorithm, expected = checksum
+        digest = digests.get(algorithm) or file_digest(target, algorithm)
+        if digest != expected:
+            ## Never keep it as base of a conditional GET
+            for path in (target, "%s.meta" % target):
+                if os.path.exists(path):
+                    os.unlink(path)
+            raise UliException("%s checksum mismatch for %s" %
+                               (algorithm, url))
+        logger.info("%s checksum of %s ok" % (algorithm, url))
+
+
+class Reporter(threading.Thread):
+    """Send timeline events and the progress of the install to the
+    backend daemon (backend.py) every interval seconds
+    
+    Best effort: events which can't be delivered are dropped, an
+    unreachable backend never fails the install.
+    """
+    
+    def __init__(self, url, interval=2):
+        threading.Thread.__init__(self, name="reporter")
+        self.daemon = True
+        self.url = url
+        self.interval = interval
+        self.fetcher = Fetcher(timeout=5)
+        self.queue = Queue.Queue()
+        self.latest = None
+        self.stopped = threading.Event()
+    
+    def add(self, event):
+        self.queue.put(event)
+    
+    def progress(self, name, done, total=None):
+        """Only the latest progress is sent"""
+        
+        self.latest = {'kind': "progress", 'name': name, 'size': done,
+                       'total': total, 'time': time.time()}
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+    
+    def flush(self):
+        events = []
+        while not self.queue.empty():
+            events.append(self.queue.get())
+        if self.latest:
+            events.append(self.latest)
+            self.latest = None
+        if not events:
+            return
+        
+        try:
+            response = self.fetcher.open(self.url, "POST",
+                                         {'Content-Type': "application/json"},
+                                         json.dumps(events))
+            response.read()
+            self.fetcher.release(response)
+        except (httplib.HTTPException, socket.error), e:
+            logger.warning("Failed to report %d events to %s: %s" %
+                           (len(events), self.url, e))
+    
+    def stop(self, state=None, error=None):
+        """Send the final state (done, failed) and what's left"""
+        
+        if state:
+            self.add({'kind': "state", 'name': state, 'rc': error,
+                      'time': time.time()})
+        self.stopped.set()
+        self.join()
+        self.flush()
+
+
+class ResponseStream:
+    """File-like view of a Fetcher response, close() releases it"""
+    
+    def __init__(self, fetcher, response):
+        self.fetcher = fetcher
+        self.response = response
+    
+    def read(self, size=-1):
+        if size < 0:
+            return self.response.read()
+        return self.response.read(size)
+    
+    def close(self):
+        self.fetcher.release(self.response)
+
+
+class ContentCache:
+    """Content addressed on-disk cache with LRU eviction
+    
+    Objects are stored as objects/<sha256>-<size>. The index maps source
+    keys (URL or path plus size and validator) to objects and keeps the
+    HTTP validators of configs. The mtime of an object is its last use.
+    """
+    
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.index_file = os.path.join(root, 'index.json')
+        
+        for d in ('objects', 'tmp'):
+            if not os.path.isdir(os.path.join(root, d)):
+                os.makedirs(os.path.join(root, d))
+    
+    def __load_index(self):
+        try:
+            return json.load(open(self.index_file))
+        except (IOError, ValueError):
+            return {}
+    
+    def __save_index(self, index):
+        with open("%s.part" % self.index_file, 'w') as f:
+            json.dump(index, f)
+        os.rename("%s.part" % self.index_file, self.index_file)
+    
+    def lookup(self, key):
+        """Return (path, meta) of the cached object for key or None"""
+        
+        with self.lock:
+            entry = self.__load_index().get(key)
+            if not entry:
+                return None
+            path = os.path.join(self.root, 'objects', entry['object'])
+            if not os.path.exists(path):
+                return None
+            os.utime(path, None)
+            logger.info("Cache hit for %s (%s)" % (key, entry['object']))
+            return path, entry.get('meta', {})
+    
+    def add(self, key, tmp_path, digest, size, meta=None):
+        """Move a completely written temp file into the cache"""
+        
+        name = "%s-%d" % (digest, size)
+        with self.lock:
+            path = os.path.join(self.root, 'objects', name)
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+                os.utime(path, None)
+            else:
+                os.rename(tmp_path, path)
+            index = self.__load_index()
+            index[key] = {'object': name, 'meta': meta or {}}
+            self.__save_index(index)
+        logger.info("Cached %s as %s" % (key, name))
+        self.evict()
+    
+    def store(self, key, source_path, meta=None):
+        """Copy a local file into the cache"""
+        
+        tee = self.tee(key, open(source_path, 'rb'), meta=meta)
+        while tee.read(CHUNK_SIZE):
+            pass
+        tee.close()
+    
+    def tee(self, key, source, size=None, meta=None, hold=False):
+        """Wrap source, everything read from it ends up in the cache"""
+        
+        return CacheTee(self, key, source, size, meta, hold)
+    
+    def remove(self, key):
+        """Forget key and drop its object"""
+        
+        with self.lock:
+            index = self.__load_index()
+            entry = index.pop(key, None)
+            if not entry:
+                return
+            self.__save_index(index)
+            path = os.path.join(self.root, 'objects', entry['object'])
+            if os.path.exists(path):
+                os.unlink(path)
+        logger.info("Removed %s from cache" % key)
+    
+    def chunk_path(self, sha, size):
+        return os.path.join(self.root, 'objects', "%s-%d" % (sha, size))
+    
+    def chunk(self, sha, size):
+        """Data of a cached image chunk or None"""
+        
+        path = self.chunk_path(sha, size)
+        try:
+            data = open(path, 'rb').read()
+        except IOError:
+            return None
+        os.utime(path, None)
+        return data
+    
+    def add_chunk(self, sha, data):
+        """Keep an image chunk (verified by the caller), no eviction: the
+        stream evicts once it is done"""
+        
+        path = self.chunk_path(sha, len(data))
+        if os.path.exists(path):
+            os.utime(path, None)
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    
+    def evict(self):
+        """Drop least recently used objects until max_size is met"""
+        
+        if not self.max_size:
+            return
+        
+        with self.lock:
+            objects = []
+            for name in os.listdir(os.path.join(self.root, 'objects')):
+                path = os.path.join(self.root, 'objects', name)
+                st = os.stat(path)
+                objects.append((st.st_mtime, st.st_size, name, path))
+            
+            total = sum([o[1] for o in objects])
+            removed = set()
+            for mtime, size, name, path in sorted(objects):
+                if total <= self.max_size:
+                    break
+                os.unlink(path)
+                removed.add(name)
+                total -= size
+                logger.info("Evicted %s from cache" % name)
+            
+            if removed:
+                index = self.__load_index()
+                for key in index.keys():
+                    if index[key]['object'] in removed:
+                        del index[key]
+                self.__save_index(index)
+
+
+class CacheTee:
+    """File-like wrapper which copies all data read into a ContentCache
+    
+    The object is added to the cache once the source hits EOF, provided
+    the expected size (if known) has been read. With hold it is only
+    added by commit() (after verifying it), else dropped on close().
+    """
+    
+    def __init__(self, cache, key, source, size=None, meta=None,
+                 hold=False):
+        self.cache = cache
+        self.key = key
+        self.source = source
+        self.size = size
+        self.meta = meta
+        self.hold = hold
+        self.complete = False
+        self.read_bytes = 0
+        self.digest = hashlib.sha256()
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.join(cache.root,
+                                                              'tmp'))
+        self.tmp = os.fdopen(fd, 'wb')
+    
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        if self.tmp is None:
+            return chunk
+        
+        if chunk:
+            self.tmp.write(chunk)
+            self.digest.update(chunk)
+            self.read_bytes += len(chunk)
+        else:
+            self.tmp.close()
+            self.tmp = None
+            if self.size is None or self.size == self.read_bytes:
+                self.complete = True
+                if not self.hold:
+                    self.commit()
+            else:
+                logger.error("Not caching %s: got %d of %d bytes" %
+                             (self.key, self.read_bytes, self.size))
+                os.unlink(self.tmp_path)
+        return chunk
+    
+    def commit(self):
+        """Add the completely read object to the cache"""
+        
+        if self.complete:
+            self.complete = False
+            self.cache.add(self.key, self.tmp_path, self.digest.hexdigest(),
+                           self.read_bytes, self.meta)
+    
+    def close(self):
+        if self.tmp is not None:
+            self.tmp.close()
+            self.tmp = None
+            os.unlink(self.tmp_path)
+        elif self.complete:
+            self.complete = False
+            os.unlink(self.tmp_path)
+        self.source.close()
+
+
+class PeerSwarm:
+    """Share image chunks with other installing hosts (peers section)
+    
+    Every host serves the chunks it already has via HTTP and announces
+    its progress (image id, number of chunks done) to a multicast group,
+    once per image it streams. Chunks are fetched in order, so a peer
+    announcing n chunks of an image has all chunks < n. A chunk is taken from a peer which is further ahead; if
+    there is none, one of the hosts at the same position is elected to
+    get it from the backend and the others wait for it.
+    """
+    
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+    
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        
+        def do_GET(self):
+            swarm = self.server.swarm
+            swarm.last_request = time.time()
+            sha = self.path.split('/')[-1]
+            path = os.path.join(swarm.spool, sha)
+            if not self.path.startswith('/chunks/') or \
+               not re.match('^[0-9a-f]{64}$', sha) or \
+               not os.path.exists(path):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            
+            data = open(path, 'rb').read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def log_message(self, format, *args):
+            logger.debug("Peer %s: %s" % (self.client_address[0],
+                                          format % args))
+    
+    def __init__(self, spool, fetcher, port=PEER_PORT, group=PEER_GROUP,
+                 group_port=PEER_GROUP_PORT, interface="0.0.0.0", wait=5):
+        self.spool = spool
+        self.fetcher = fetcher
+        self.group = (group, group_port)
+        self.interface = interface
+        self.wait = wait
+        self.id = "%016x" % random.getrandbits(64)
+        self.images = {}
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.last_request = 0
+        self.backend_chunks = 0
+        self.peer_chunks = 0
+        
+        if not os.path.isdir(spool):
+            os.makedirs(spool)
+        
+        self.server = self.Server(('', port), self.Handler)
+        self.server.swarm = self
+        self.port = self.server.server_address[1]
+        
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                               socket.inet_aton(interface))
+        
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.receiver.bind(('', group_port))
+        self.receiver.setsockopt(socket.IPPROTO_IP,
+                                 socket.IP_ADD_MEMBERSHIP,
+                                 socket.inet_aton(group) +
+                                 socket.inet_aton(interface))
+        self.receiver.settimeout(0.5)
+    
+    def start(self):
+        """Start serving, announcing and listening"""
+        
+        self.running.set()
+        for target in (self.server.serve_forever, self.__announcer,
+                       self.__listener):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+        logger.info("Peer swarm %s serving on port %d" % (self.id, self.port))
+    
+    def stop(self, linger=0):
+        """Keep serving until no peer asked for linger seconds, then stop"""
+        
+        while time.time() - max(self.last_request, 0) < linger:
+            time.sleep(0.5)
+        
+        self.running.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        self.sender.close()
+        shutil.rmtree(self.spool, ignore_errors=True)
+        logger.info("Peer swarm stopped: %d chunks from peers, %d from "
+                    "backend" % (self.peer_chunks, self.backend_chunks))
+    
+    def announce(self, image=None):
+        """Tell the other peers how far we are (with image or all images)"""
+        
+        with self.lock:
+            images = image and [image] or self.images.keys()
+            msgs = [json.dumps({'id': self.id, 'port': self.port,
+                                'image': i, 'count': self.images[i]})
+                    for i in images]
+        for msg in msgs:
+            try:
+                self.sender.sendto(msg, self.group)
+            except socket.error, e:
+                logger.error("Peer announcement failed: %s" % e)
+    
+    def __announcer(self):
+        while self.running.is_set():
+            self.announce()
+            time.sleep(1)
+    
+    def __listener(self):
+        while self.running.is_set():
+            try:
+                data, addr = self.receiver.recvfrom(4096)
+                msg = json.loads(data)
+                ## Anything else on the group must not kill the listener
+                peer = (addr[0], int(msg['port']), int(msg['count']),
+                        time.time())
+                key = (str(msg['id']), str(msg['image']))
+            except socket.timeout:
+                continue
+            except (socket.error, ValueError, KeyError, TypeError):
+                continue
+            with self.lock:
+                self.peers[key] = peer
+        self.receiver.close()
+    
+    def __peers(self, image, position):
+        """Alive peers of image: (further ahead, at position)"""
+        
+        ahead = []
+        same = [self.id]
+        with self.lock:
+            for (id, peer_image), (ip, port, count, seen) in \
+                self.peers.items():
+                if id == self.id or peer_image != image or \
+                   time.time() - seen > 10:
+                    continue
+                if count > position:
+                    ahead.append((ip, port))
+                elif count == position:
+                    same.append(id)
+        return ahead, same
+    
+    def __from_peer(self, peer, sha):
+        """Get a chunk from a peer (None if it fails)"""
+        
+        try:
+            r = self.fetcher.open("http://%s:%d/chunks/%s" % (peer[0],
+                                                              peer[1], sha))
+            data = r.read()
+            self.fetcher.release(r)
+        except (httplib.HTTPException, socket.error), e:
+            logger.error("Peer %s:%d failed: %s" % (peer[0], peer[1], e))
+            return None
+        if r.status != 200 or hashlib.sha256(data).hexdigest() != sha:
+            return None
+        return data
+    
+    def __from_backend(self, url, offset, sha, size):
+        """Get a chunk via range request from the backend"""
+        
+        data = fetch_range(self.fetcher, url, offset, size)
+        if hashlib.sha256(data).hexdigest() != sha:
+            raise UliException("Chunk %s of %s is corrupt" % (sha, url))
+        return data
+    
+    def chunk(self, image, url, position, offset, sha, size):
+        """Get the chunk of image at position (peers first, then backend)"""
+        
+        path = os.path.join(self.spool, sha)
+        if os.path.exists(path):
+            return open(path, 'rb').read()
+        
+        deadline = time.time() + self.wait
+        while True:
+            ahead, same = self.__peers(image, position)
+            random.shuffle(ahead)
+            for peer in ahead[:3]:
+                data = self.__from_peer(peer, sha)
+                if data is not None:
+                    self.peer_chunks += 1
+                    return data
+            
+            elected = min(same, key=lambda id: hashlib.sha1(
+                                        "%s%d" % (id, position)).hexdigest())
+            if elected == self.id or time.time() > deadline:
+                self.backend_chunks += 1
+                return self.__from_backend(url, offset, sha, size)
+            time.sleep(0.1)
+    
+    def stream(self, url, manifest, cache=None):
+        """File-like object delivering the image described by manifest
+        
+        Several images (or the same one twice) can be streamed at once.
+        """
+        
+        image = hashlib.sha256(json.dumps(manifest,
+                                          sort_keys=True)).hexdigest()
+        with self.lock:
+            self.images.setdefault(image, 0)
+        return ChunkStream(url, manifest, self.fetcher, cache, self, image)
+    
+    def add(self, image, position, sha, data):
+        """Keep the chunk of image at position to serve it to the other
+        peers"""
+        
+        path = os.path.join(self.spool, sha)
+        if not os.path.exists(path):
+            with open("%s.part" % path, 'wb') as f:
+                f.write(data)
+            os.rename("%s.part" % path, path)
+        ## Two streams of the same image: the spool has all chunks up to
+        ## the one further ahead
+        with self.lock:
+            self.images[image] = max(self.images[image], position + 1)
+        self.announce(image)
+
+
+class ChunkStream:
+    """File-like object reading an image chunk by chunk
+    
+    Chunks in the cache (from earlier installs of this or an older
+    version of the image) are taken from there, only the missing ones are
+    fetched: via the swarm if there is one, else with a range request to
+    the backend per run of missing chunks. Fetched chunks are verified
+    and added to the cache.
+    """
+    
+    def __init__(self, url, manifest, fetcher, cache=None, swarm=None,
+                 image=None):
+        self.url = url
+        self.image = image
+        self.chunks = manifest['chunks']
+        self.fetcher = fetcher
+        self.cache = cache
+        self.swarm = swarm
+        self.position = 0
+        self.offset = 0
+        self.buffer = ""
+        self.pending = []
+        self.reused = 0
+        self.start = time.time()
+    
+    def __cached(self, position):
+        sha, length = self.chunks[position]
+        return self.cache and \
+               os.path.exists(self.cache.chunk_path(sha, length))
+    
+    def __fetch(self):
+        """Fetch the run of missing chunks at position (one request)"""
+        
+        end = self.position
+        size = 0
+        while end < len(self.chunks) and not self.__cached(end) and \
+              (not size or size + self.chunks[end][1] <= DELTA_RANGE):
+            size += self.chunks[end][1]
+            end += 1
+        
+        data = fetch_range(self.fetcher, self.url, self.offset, size)
+        if len(data) != size:
+            raise UliException("Short read from %s: %d of %d bytes" %
+                               (self.url, len(data), size))
+        pos = 0
+        for sha, length in self.chunks[self.position:end]:
+            chunk = data[pos:pos + length]
+            if hashlib.sha256(chunk).hexdigest() != sha:
+                raise UliException("Chunk %s of %s is corrupt" %
+                                   (sha, self.url))
+            self.pending.append(chunk)
+            pos += length
+    
+    def __next(self):
+        sha, length = self.chunks[self.position]
+        if self.pending:
+            data = self.pending.pop(0)
+        else:
+            data = self.cache and self.cache.chunk(sha, length)
+            if data:
+                self.reused += length
+            elif self.swarm:
+                data = self.swarm.chunk(self.image, self.url, self.position,
+                                        self.offset, sha, length)
+            else:
+                self.__fetch()
+                data = self.pending.pop(0)
+        
+        if self.cache:
+            self.cache.add_chunk(sha, data)
+        if self.swarm:
+            self.swarm.add(self.image, self.position, sha, data)
+        self.position += 1
+        self.offset += length
+        return data
+    
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and \
+              self.position < len(self.chunks):
+            self.buffer += self.__next()
+        
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+    
+    def close(self):
+        if self.position and self.position == len(self.chunks):
+            logger.info("%s: %d bytes from the cache, %d fetched" %
+                        (self.url, self.reused, self.offset - self.reused))
+            timeline.record("delta", self.url, self.start,
+                            rc="%d reused" % self.reused,
+                            size=self.offset - self.reused)
+        if self.cache:
+            self.cache.evict()
+
+
+class Planner:
+    """Compile a config into the commands an install would run (dry-run)
+    
+    Nothing is executed and no disk is touched. Every entry names the
+    step, the steps it depends on, the command (plus its input), a group
+    (entries of a step in different groups may run concurrently) and the
+    estimated number of bytes written.
+    """
+    
+    def __init__(self, config, root='/install', image_size=None):
+        self.config = config
+        self.root = root
+        self.image_size = image_size
+        self.entries = []
+        self.step = None
+    
+    def validate(self):
+        """Raise UliException for configs an install would fail on"""
+        
+        errors = validate_config(self.config)
+        if errors:
+            raise UliException("; ".join(errors))
+    
+    def add(self, command, input=None, group=None, bytes=None):
+        self.entries.append({'step': self.step,
+                             'after': list(dict(Installer.steps)[self.step]),
+                             'group': group, 'command': command,
+                             'input': input, 'bytes': bytes})
+    
+    def plan(self):
+        """Return the list of plan entries in execution order"""
+        
+        self.validate()
+        self.entries = []
+        for name, deps in Installer.steps:
+            self.step = name
+            getattr(self, "step_%s" % name)()
+        return self.entries
+    
+    def __partition_sizes(self):
+        """{partition number: size in bytes or None}"""
+        
+        partitions = self.config['diskmgmt']['partitions']
+        return dict([(i + 1, partitions[p]['size'] and
+                      int(partitions[p]['size']) * 1024 ** 2)
+                     for i, p in enumerate(partitions)])
+    
+    def step_verify_disks(self):
+        self.add("/sbin/vgchange -an")
+        for i in range(0, 4):
+            self.add("/sbin/mdadm --stop /dev/md%d" % i)
+    
+    def step_partitioning(self):
+        echo_str, p_ids = sfdisk_input(self.config['diskmgmt']['partitions'])
+        wipe = self.config['diskmgmt'].get('wipe', 'signatures')
+        wiped = {'urandom': WIPE_SIZE, 'zero': WIPE_SIZE + 2 * MD_RESERVED}
+        
+        for d in self.config['diskmgmt']['disks']:
+            self.add("/sbin/sfdisk %s -uM" % d, echo_str, d)
+            for id in p_ids:
+                self.add("/sbin/sfdisk --id %s %d %s" % (d, id, p_ids[id]),
+                         group=d)
+            self.add("/sbin/sfdisk -R %s" % d, group=d)
+            for id in p_ids:
+                self.add("<wipe:%s> %s" % (wipe, partition_name(d, id)),
+                         group=d, bytes=wiped.get(wipe, WIPE_BLOCK +
+                                                  2 * MD_RESERVED))
+                self.add("/sbin/mdadm --zero-superblock %s" %
+                         partition_name(d, id), group=d)
+    
+    def step_mdadm(self):
+        if self.config['diskmgmt']['type'] != "md":
+            return
+        
+        disks = self.config['diskmgmt']['disks']
+        resync = self.config['diskmgmt'].get('resync') or {}
+        sizes = self.__partition_sizes()
+        for p_id in sorted(sizes):
+            devs = [partition_name(d, p_id) for d in disks]
+            self.add(mdadm_create_command(p_id - 1, devs,
+                                          resync.get('assume_clean')),
+                     bytes=not resync.get('assume_clean') and sizes[p_id] and
+                           sizes[p_id] * len(devs) or None)
+            if resync.get('defer'):
+                self.add("echo frozen > %s" %
+                         md_sysfs(p_id - 1, 'sync_action'))
+            for key in ('speed_min', 'speed_max'):
+                if resync.get(key):
+                    self.add("echo %s > %s" %
+                             (resync[key], md_sysfs(p_id - 1, "sync_%s" % key)))
+    
+    def step_lvm(self):
+        for v in sorted(self.config.get('lvm', {}).get('vg', {})):
+            for command in lvm_commands(v, self.config['lvm']['vg'][v]):
+                self.add(command, group=v)
+    
+    def step_swap(self):
+        for fs in sorted(self.config['fs']):
+            if fs == "none" or self.config['fs'][fs]['type'] == "swap":
+                self.add("/sbin/mkswap %s" % self.config['fs'][fs]['dev'])
+    
+    def step_filesystems(self):
+        fs_cfg = self.config['fs']
+        mounts = [fs for fs in fs_cfg
+                  if fs != "none" and fs_cfg[fs]['type'] != "swap"]
+        for fs in sorted(mounts):
+            if fs_cfg[fs].get('image'):
+                self.add("<image:%s> %s" % (fs_cfg[fs]['image'],
+                                            fs_cfg[fs]['dev']), group=fs)
+            else:
+                self.add(mkfs_command(fs_cfg[fs]), group=fs)
+        for level in mount_order(mounts):
+            for fs in level:
+                self.add(mount_command(fs_cfg[fs],
+                         os.path.join(self.root, fs.lstrip('/')),
+                         fs_tuning(fs_cfg[fs]).get('install_options')),
+                         group="mount")
+    
+    def step_install(self):
+        image = self.config['global'].get('image')
+        if not image:
+            return
+        decompressor, extract = extract_command(image, self.root,
+                                    self.config['global'].get('decompressor'))
+        source = "<%s:%s>" % (self.config['global'].get('transfer', 'nfs'),
+                              image)
+        self.add(" | ".join([c for c in (source, decompressor, extract) if c]),
+                 bytes=self.image_size)
+    
+    def step_remount(self):
+        fs_cfg = self.config['fs']
+        mounts = [fs for fs in fs_cfg
+                  if fs != "none" and fs_cfg[fs]['type'] != "swap"]
+        if not [fs for fs in mounts if fs_tuning(fs_cfg[fs])]:
+            return
+        
+        for fs in sorted(mounts, key=len, reverse=True):
+            self.add("/bin/umount %s" %
+                     os.path.normpath(os.path.join(self.root, fs.lstrip('/'))))
+        for level in mount_order(mounts):
+            for fs in level:
+                self.add(mount_command(fs_cfg[fs],
+                         os.path.join(self.root, fs.lstrip('/')),
+                         fs_options(fs_cfg[fs])), group="mount")
+    
+    def step_md_resync(self):
+        if self.config['diskmgmt']['type'] != "md":
+            return
+        
+        resync = self.config['diskmgmt'].get('resync') or {}
+        for p_id in sorted(self.__partition_sizes()):
+            if resync.get('defer'):
+                self.add("echo idle > %s" % md_sysfs(p_id - 1, 'sync_action'))
+            for key in ('speed_min', 'speed_max'):
+                if resync.get(key):
+                    self.add("echo system > %s" %
+                             md_sysfs(p_id - 1, "sync_%s" % key))
+    
+    def step_mount_pseudo(self):
+        self.add("/bin/mount -t proc -o bind /proc %s" %
+                 os.path.join(self.root, 'proc'))
+        self.add("/bin/mount -t sysfs -o bind /sys %s" %
+                 os.path.join(self.root, 'sys'))
+    
+    def step_configure(self):
+        files = ["etc/conf.d/hostname", "etc/hosts", "etc/fstab",
+                 "boot/grub/grub.conf"]
+        if "net" in self.config:
+            files.insert(0, "etc/conf.d/net")
+        for f in files:
+            self.add("<write> %s" % os.path.join(self.root, f))
+        for nic in sorted(self.config.get('net', {})):
+            self.add("/usr/bin/chroot %s /sbin/rc-update add net.%s default"
+                     % (self.root, nic))
+    
+    def step_grub(self):
+        for c, d in enumerate(self.config['diskmgmt']['disks']):
+            self.add("/sbin/grub --batch --no-curses --no-floppy",
+                     grub_input(c, d), d)
+    
+    def text(self):
+        """Human readable plan"""
+        
+        lines = []
+        for e in self.entries:
+            line = "%-14s %s%s" % (e['step'],
+                                   e['group'] and "[%s] " % e['group'] or "",
+                                   " ".join(e['command'].split()))
+            if e['input']:
+                line += " <<< %r" % e['input']
+            if e['bytes']:
+                line += "  (%.1f MB)" % (e['bytes'] / 1024.0 ** 2)
+            lines.append(line)
+        total = sum([e['bytes'] or 0 for e in self.entries])
+        lines.append("%d commands, ~%.1f MB written" %
+                     (len(self.entries), total / 1024.0 ** 2))
+        return "\n".join(lines)
+
+
 class Installer:
     """Installer class: This is where the magic happens"""
     
-    spinner_stop = False
+    ## Install steps and their dependencies, listed in the serial order
+    steps = (('verify_disks', ()),
+             ('partitioning', ('verify_disks',)),
+             ('mdadm', ('partitioning',)),
+             ('lvm', ('mdadm',)),
+             ('swap', ('lvm',)),
+             ('filesystems', ('lvm',)),
+             ('install', ('filesystems',)),
+             ('md_resync', ('install',)),
+             ('remount', ('install',)),
+             ('mount_pseudo', ('remount',)),
+             ('configure', ('install', 'mount_pseudo')),
+             ('grub', ('configure',)),
+            )
+    
+    ## Config sections the result of a step depends on (besides the
+    ## results of its dependencies), see Journal
+    step_config = {'verify_disks': ('diskmgmt.disks', 'lvm'),
+                   'partitioning': ('diskmgmt',),
+                   'mdadm': ('diskmgmt',),
+                   'lvm': ('lvm',),
+                   'swap': ('fs',),
+                   'filesystems': ('fs', 'global.image'),
+                   'install': ('global.image',),
+                   'md_resync': ('diskmgmt.resync',),
+                   'remount': ('fs',),
+                   'mount_pseudo': (),
+                   'configure': ('global', 'net', 'fs'),
+                   'grub': ('diskmgmt.disks',),
+                  }
+    ## Steps a rerunning step needs done for real, not resumed: disks
+    ## with active md arrays and VGs can't be partitioned again, an image
+    ## extracted over the leftovers of a failed install needs fresh
+    ## filesystems
+    step_consumes = {'partitioning': ('verify_disks',),
+                     'mdadm': ('verify_disks',),
+                     'lvm': ('verify_disks',),
+                     'install': ('filesystems',)}
     
     class Spinner(threading.Thread):
+        """Spinner behind the current task, plus MB done, MB/s and ETA
+        once update() reports progress
+        
+        Redraws every interval until stop() (no flag polling after
+        that), writes the progress to the log every log_interval.
+        """
+        
+        chars = "/-\\|"
+        
+        def __init__(self, task, width, interval=0.2, log_interval=10):
+            threading.Thread.__init__(self, name="spinner")
+            self.daemon = True
+            self.task = task
+            self.width = max(width, 1)
+            self.interval = interval
+            self.log_interval = log_interval
+            self.stopped = threading.Event()
+            self.done = None
+            self.total = None
+            ## (time, done) of the last seconds for the current rate
+            self.samples = []
+            ## Shown if there's no progress
+            self.status = None
+            ## What's on the line behind the task (the trailing space)
+            self.shown = " "
+        
+        def update(self, done, total=None):
+            if total:
+                self.total = total
+            self.done = done
+            self.samples.append((time.time(), done))
+            while self.samples[-1][0] - self.samples[0][0] > 5:
+                self.samples.pop(0)
+        
+        def progress(self):
+            """'12.0/40.0 MB  3.5 MB/s  ETA 0:08' (or None)"""
+            
+            if self.done is None:
+                return None
+            
+            text = "%.1f" % (self.done / 1024.0 ** 2)
+            if self.total:
+                text += "/%.1f" % (self.total / 1024.0 ** 2)
+            text += " MB"
+            
+            seconds = self.samples[-1][0] - self.samples[0][0]
+            if seconds > 0:
+                rate = (self.samples[-1][1] - self.samples[0][1]) / seconds
+                text += "  %.1f MB/s" % (rate / 1024.0 ** 2)
+                if self.total and rate > 0:
+                    eta = max(self.total - self.done, 0) / rate
+                    text += "  ETA %d:%02d" % (eta / 60, eta % 60)
+            return text
+        
+        def draw(self, text):
+            ## Pad to overwrite everything shown before
+            text = text[:self.width].ljust(len(self.shown))
+            sys.stdout.write("\b" * len(self.shown) + text)
+            sys.stdout.flush()
+            self.shown = text
+        
         def run(self):
-                global spinner_stop
-                sys.stdout.flush()
-                type = 0
-                while spinner_stop != True:
-                        if type == 0:
-                            sys.stdout.write("\b/")
-                        if type == 1:
-                            sys.stdout.write("\b-")
-                        if type == 2:
-                            sys.stdout.write("\b\\")
-                        if type == 3:
-                            sys.stdout.write("\b|")
-                        type += 1
-                        if type == 4:
-                            type = 0
-                        sys.stdout.flush()
-                        time.sleep(0.2)
-    
-    def __init__(self, after_reload=False):
-        
-        global spinner_stop
-        
-        self.root = '/install'
+            tick = 0
+            logged = time.time()
+            while not self.stopped.wait(self.interval):
+                text = self.chars[tick % len(self.chars)]
+                tick += 1
+                progress = self.progress()
+                if progress:
+                    text += " %s" % progress
+                    if time.time() - logged >= self.log_interval:
+                        logger.info("%s: %s" % (self.task, progress))
+                        logged = time.time()
+                elif self.status:
+                    text += " %s" % self.status
+                self.draw(text)
+        
+        def stop(self):
+            """Stop drawing, leaves one character behind the task"""
+            
+            self.stopped.set()
+            self.join()
+            if self.progress():
+                logger.info("%s: %s" % (self.task, self.progress()))
+            self.draw("")
+            sys.stdout.write("\b" * (len(self.shown) - 1))
+            self.shown = " "
+    
+    def __init__(self, after_reload=False, root=None, backend=None,
+                 mac=None, local_config=None):
+        
+        self.root = root or '/install'
         if not os.path.exists(self.root):
             os.mkdir(self.root)
         
-        self.backend = self.__get_backend_addr()
+        self.backend = backend or self.__get_backend_addr()
         self.download_url = "http://%s/U.L.I." % self.backend
+        self.image_url = "http://%s/images" % self.backend
         self.plugin_url = "http://%s/U.L.I./ULI_Plugins.py" % self.backend
-        self.mac_escaped = self.__get_mac_addr().replace(':', '_').lower()
-        self.local_config = os.path.join(os.path.dirname(__file__), 'uli.yaml')
+        self.orchestrator_url = "http://%s/orchestrator" % self.backend
+        self.mac_escaped = (mac or self.__get_mac_addr()).replace(':',
+                                                                  '_').lower()
+        self.local_config = local_config or \
+                            os.path.join(os.path.dirname(__file__), 'uli.yaml')
+        self.compiled_config = "%s.json" % \
+                               os.path.splitext(self.local_config)[0]
+        self.config_file = self.local_config
+        self.local_plugin = os.path.join(os.path.dirname(__file__),
+                                         'ULI_Plugins.py')
         self.msg_length = 0
+        self.spinner = None
         self.spinner_active = False
         self.nfs_mount = "/mnt/images"
+        self.fetcher = Fetcher()
+        self.swarm = None
+        self.reporter = None
+        self.journal = None
+        ## Steps resumed from the journal in this run, in order
+        self.resumed = []
+        self.cache = None
+        
+        ## md resync tuning: sysfs path => value to restore
+        self.md_saved = {}
+        self.md_deferred = []
+        self.md_monitor = None
+        if os.path.isdir(CACHE_DIR):
+            self.cache = ContentCache(CACHE_DIR)
+        
+        ## Parallel steps: tasks are printed as one line once they're done
+        self.concurrent = False
+        self.console = threading.RLock()
+        self.task = threading.local()
     
     def __print(self, msg, color=None, nl=True, attr=None):
         """Print colored messages to STDOUT"""
@@ -144,8 +2825,9 @@ class Installer:
     
     def __error(self, msg):
         """Print errors to STDOUT and raise"""
-        print(colored("\n[error] %s\n" % msg, "red", attrs=["bold"]))
-        sys.stdout.flush()
+        with self.console:
+            print(colored("\n[error] %s\n" % msg, "red", attrs=["bold"]))
+            sys.stdout.flush()
         raise UliException(msg)
     
     def __get_mac_addr(self):
@@ -162,69 +2844,83 @@ class Installer:
         
         GW = re.compile(
                     r'^default\svia\s(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s')
-        routes = execute('/sbin/ip route list')
-        for r in routes.splitlines():
-            if GW.match(r):
-                return GW.match(r).group(1)
-    
-    def __get_screen_dim(self):
-        """Return lines and columns auf current terminal"""
-        
-        try:
-            return map(int, os.popen('stty size', 'r').read().split())
-        except OSError:
-            logger.error("Failed to get terminal size (Fallback: 80x24)")
-            return [24, 80]
-    
-    def __url_exists(self, url):
-        """Raise if URL is not valid"""
-        
-        try:
-            r = urllib2.urlopen(url)
-            return True
-        except urllib2.URLError, e:
-            if not hasattr(e, "code"):
-                raise
-            else:
-                return False
+        routes = execute('/sbin/ip route list')
+        for r in routes.splitlines():
+            if GW.match(r):
+                return GW.match(r).group(1)
     
-    def __url_fetch(self, url, target):
-        """Download item from url to target"""
+    def __get_screen_dim(self):
+        """Return lines and columns auf current terminal"""
         
-        d = urllib.urlretrieve(url, target)
-        return os.path.exists(d[0])
+        try:
+            dim = map(int, os.popen('stty size 2>/dev/null',
+                                    'r').read().split())
+            if len(dim) == 2 and dim[1] > 0:
+                return dim
+        except (OSError, ValueError):
+            pass
+        logger.error("Failed to get terminal size (Fallback: 80x24)")
+        return [24, 80]
     
     def start_task(self, msg, spinner=True):
         """Print task description and initialize the spinner"""
         
-        if spinner:
-            progress = self.Spinner()
-            global spinner_stop
-            spinner_stop = False
-        
         output = ">> %s  " % msg
-        self.msg_length = len(output)        
         colored_output = output.replace(">>", colored(">>", "cyan", attrs=["bold"]))
         
+        if self.concurrent:
+            self.task.output = colored_output
+            self.task.length = len(output)
+            return
+        
+        self.msg_length = len(output)
+        
         self.__print(colored_output, None, False)
         
         if spinner:
+            ## Room for the progress, the result has to fit too
+            self.spinner = self.Spinner(msg, self.__get_screen_dim()[1] -
+                                        self.msg_length - len("[ ok ]") - 2)
             self.spinner_active = True
-            progress.start()
+            self.spinner.start()
+    
+    def status(self, text):
+        """Show a status (e.g. queue position) behind the current task"""
+        
+        if self.spinner:
+            self.spinner.status = text
+    
+    def progress(self, done, total=None):
+        """Report the progress (bytes) of the current task"""
+        
+        if self.spinner:
+            self.spinner.update(done, total)
+        if self.reporter:
+            self.reporter.progress(self.spinner and self.spinner.task,
+                                   done, total)
     
     def stop_task(self, state, spinner=True):
         """Print task result and terminate spinner"""
         
-        if spinner:
-            global spinner_stop
-            spinner_stop = True
-        
         s_map = {'ok': ('[ ok ]', 'green',),
                  'failed': ('[ !! ]', 'red',),
                  'warning': ('[ !? ]', 'red',),
                  'skip': ('[ -- ]', 'yellow',),
                 }
         
+        if self.concurrent:
+            ws = " " * (self.__get_screen_dim()[1] - self.task.length -
+                        len(s_map[state][0]))
+            with self.console:
+                self.__print("%s%s%s" % (self.task.output, ws,
+                             colored(s_map[state][0], s_map[state][1],
+                                     attrs=["bold"])))
+            return
+        
+        if spinner and self.spinner:
+            self.spinner.stop()
+            self.spinner = None
+        
         ws = " " * (self.__get_screen_dim()[1] - self.msg_length - len(s_map[state][0]))
         self.__print("\b %s%s" % (ws, s_map[state][0]),
                                   s_map[state][1], attr=["bold"])
@@ -236,27 +2932,189 @@ class Installer:
         """This is the bootstrap"""
         
         try:
-            self.download_config()
-            self.parse_config()
+            self.step('download_config')
+            self.step('parse_config')
+            self.step('setup_cache')
+            self.start_reporter()
+            
+            if self.config['global'].get('resume', True):
+                self.journal = Journal()
             
             if self.config['global']['interactive'] is True:
                 self.mount_nfs()
                 self.image_selection()
             
-            self.verify_disks()
-            self.partitioning()
-            self.mdadm()
-            self.lvm()
-            self.filesystems()
-            self.install()
-            self.mount_pseudo()
-            self.configure()
-            self.grub()
+            self.run_steps()
+            if self.journal:
+                self.journal.clear()
+            self.stop_swarm()
+            if self.md_monitor:
+                self.md_monitor.stop()
+            self.write_timeline()
+            self.stop_reporter("done")
             self.byebye()
         except:
+            ## e.g. Ctrl-C while a command runs
+            Process.cancel_all()
             if self.spinner_active:
                 self.stop_task("failed")
-                raise
+            if self.swarm:
+                self.swarm.stop()
+            try:
+                self.restore_resync()
+            except (IOError, OSError), e:
+                logger.error("Failed to restore md resync settings: %s" % e)
+            if self.md_monitor:
+                self.md_monitor.stop()
+            self.write_timeline()
+            self.stop_reporter("failed", str(sys.exc_info()[1]))
+            raise
+    
+    def step(self, name):
+        """Run a single step and record its duration in the timeline
+        
+        Install steps the journal has for the current config are resumed
+        instead (resume_<step>), if that works out.
+        """
+        
+        start = time.time()
+        digest = None
+        if self.journal and name in self.step_config:
+            digest = self.__step_digest(name)
+        try:
+            if digest and self.journal.done(name, digest) and \
+               self.__resume(name):
+                self.resumed.append(name)
+                timeline.record("step", name, start, rc="resumed")
+                return
+            if digest:
+                self.journal.invalidate([name] + self.__dependents(name))
+                self.__redo_consumed(name)
+            getattr(self, name)()
+        except:
+            timeline.record("step", name, start, rc="failed")
+            raise
+        if digest:
+            self.journal.add(name, digest)
+        timeline.record("step", name, start, rc="ok")
+    
+    def __step_digest(self, name):
+        """Digest of the step's config and those of its dependencies"""
+        
+        deps = dict(self.steps)
+        return config_digest(self.config, self.step_config[name],
+                             *[self.__step_digest(d) for d in deps[name]])
+    
+    def __dependents(self, name):
+        """All steps depending (indirectly) on the step"""
+        
+        dependents = []
+        for step, deps in self.steps:
+            if [d for d in deps if d == name or d in dependents]:
+                dependents.append(step)
+        return dependents
+    
+    def __redo_consumed(self, name):
+        """Run the resumed steps name consumes (step_consumes) for real,
+        then restore the steps resumed after them again"""
+        
+        for consumed in self.step_consumes.get(name, ()):
+            if consumed not in self.resumed:
+                continue
+            logger.info("%s runs again, so %s has to" % (name, consumed))
+            later = self.resumed[self.resumed.index(consumed) + 1:]
+            self.resumed.remove(consumed)
+            getattr(self, consumed)()
+            for step in later:
+                if not self.__resume(step):
+                    raise UliException("Failed to restore %s after %s" %
+                                       (step, consumed))
+    
+    def __resume(self, name):
+        """Restore the state of a step done in a previous run, False if
+        the step has to run again"""
+        
+        self.start_task("Resuming %s from checkpoint" % name)
+        try:
+            resumed = getattr(self, "resume_%s" % name, lambda: True)()
+        except Exception, e:
+            logger.warning("Resuming %s failed: %s" % (name, e))
+            resumed = False
+        self.stop_task(resumed and "skip" or "warning")
+        return resumed
+    
+    def write_timeline(self):
+        """Write the timeline to TIMELINE.{json,csv} (and into the target's
+        /var/log) and print the summary"""
+        
+        targets = [TIMELINE]
+        if os.path.isdir(os.path.join(self.root, 'var/log')):
+            targets.append(os.path.join(self.root, TIMELINE.lstrip('/')))
+        
+        try:
+            for t in targets:
+                timeline.write(t)
+        except (IOError, OSError), e:
+            logger.error("Failed to write timeline: %s" % e)
+        
+        logger.info("Install timeline:\n%s" % timeline.summary())
+        with self.console:
+            self.__print("\n%s" % timeline.summary(), "cyan")
+    
+    def run_steps(self, only=None):
+        """Run the install steps (or only the given ones), serial or
+        (global.scheduler: parallel) as dependency graph"""
+        
+        steps = self.steps
+        if only:
+            steps = [(name, tuple([d for d in deps if d in only]))
+                     for name, deps in steps if name in only]
+        
+        if self.config['global'].get('processes'):
+            set_process_limit(int(self.config['global']['processes']))
+        
+        workers = 1
+        if self.config['global'].get('scheduler', 'serial') == "parallel":
+            workers = self.__workers()
+            self.concurrent = workers != 1
+        
+        try:
+            run_graph(steps, self.step, workers)
+        finally:
+            self.concurrent = False
+    
+    def __fetch_cached(self, url, target):
+        """Fetcher.fetch() with a cached copy as conditional GET base"""
+        
+        meta_file = "%s.meta" % target
+        cached = self.cache and self.cache.lookup(url)
+        if cached and not os.path.exists(target):
+            shutil.copy(cached[0], target)
+            with open(meta_file, 'w') as f:
+                json.dump(cached[1], f)
+        
+        downloaded = self.fetcher.fetch(url, target, verify=True)
+        if downloaded and self.cache:
+            self.cache.store(url, target, json.load(open(meta_file)))
+        return downloaded
+    
+    def __compiled_current(self, yaml_url):
+        """False if the downloaded prevalidated JSON was made from another
+        version of the YAML (checked against the checksum file of the
+        YAML, if the backend has one)"""
+        
+        checksum = fetch_checksum(self.fetcher, yaml_url)
+        if not checksum or checksum[0] != "sha256":
+            return True
+        try:
+            digest = json.load(open(self.compiled_config)).get('sha256')
+        except ValueError:
+            digest = None
+        if digest != checksum[1]:
+            logger.warning("Prevalidated config is stale, using %s" %
+                           yaml_url)
+            return False
+        return True
     
     def download_config(self):
         """Config download (personal or fallback)"""
@@ -275,37 +3133,76 @@ class Installer:
         for c in configs:
             self.start_task("Attempting to download %s-config %s" %
                             (configs[c]['type'], configs[c]['cfg']))
-            if self.__url_exists(configs[c]['url']):
-                try:
-                    if self.__url_fetch(configs[c]['url'],
-                                          self.local_config):
-                        self.stop_task("ok")
-                    else:
-                        self.stop_task("failed")
-                        self.__error("Failed to download %s" %
-                                    configs[c]['cfg'])
-                except:
-                    raise
+            try:
+                ## Prevalidated JSON (validate.py) first, then the YAML
+                for target in (self.compiled_config, self.local_config):
+                    url = "%s%s" % (configs[c]['url'][:-len('.yaml')],
+                                    os.path.splitext(target)[1])
+                    downloaded = self.__fetch_cached(url, target)
+                    if downloaded and target == self.compiled_config and \
+                       not self.__compiled_current(configs[c]['url']):
+                        downloaded = False
+                    if downloaded:
+                        self.config_file = target
+                        break
+            except:
+                self.stop_task("failed")
+                raise
+            
+            if downloaded:
+                self.stop_task("ok")
+                break
+            elif configs[c]['can_fail']:
+                self.stop_task("skip")
             else:
-                if configs[c]['can_fail']:
-                        self.stop_task("skip")
-                else:
-                    self.stop_task("failed")
-                    self.__error("Failed to download config %s => %s" %
-                                (configs[c]['cfg'], e))
-                    raise
+                self.stop_task("failed")
+                self.__error("Failed to download config %s" %
+                             configs[c]['cfg'])
     
     def parse_config(self):
         """Parse the YAML config"""
         
         try:
-            self.start_task("Parsing downloaded YAML config")
-            self.config = yaml.load(file(self.local_config, 'r'))
-            self.stop_task("ok")
-        except yaml.YAMLError, e:
+            self.start_task("Parsing downloaded config %s" %
+                            os.path.basename(self.config_file))
+            if self.config_file == self.compiled_config:
+                self.config = normalize_config(
+                                json.load(open(self.config_file))['config'])
+            else:
+                self.config = load_config(open(self.config_file).read())
+        except (yaml.YAMLError, ValueError, KeyError), e:
             self.stop_task("failed")
-            self.__error("Failed to parse YAML config: %s" % e)
+            self.__error("Failed to parse config: %s" % e)
             raise
+        
+        ## Better now than after the disks have been wiped
+        errors = validate_config(self.config)
+        if errors:
+            self.stop_task("failed")
+            self.__error("Invalid config: %s" % "; ".join(errors))
+        self.stop_task("ok")
+    
+    def setup_cache(self):
+        """Mount and open the local image/config cache (cache section)"""
+        
+        if "cache" not in self.config:
+            return
+        
+        cfg = self.config['cache']
+        path = cfg.get('path', CACHE_DIR)
+        
+        try:
+            self.start_task("Opening local cache %s" % path)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            if cfg.get('dev') and not os.path.ismount(path):
+                execute("/bin/mount %s %s" % (cfg['dev'], path))
+            self.cache = ContentCache(path, parse_size(cfg.get('max_size')))
+            self.cache.evict()
+            self.stop_task("ok")
+        except Exception, e:
+            self.stop_task("failed")
+            self.__error("Failed to open cache %s: %s" % (path, e))
     
     def mount_nfs(self):
         """Mount the NFS images share"""
@@ -360,6 +3257,9 @@ class Installer:
         try:
             self.start_task("Resetting and verifying disk(s)")
             
+            ## Leftovers of a failed run keep the VGs and arrays busy
+            self.__unmount_root()
+            
             lvm_devices = list(self.config['diskmgmt']['disks'])
             if "lvm" in self.config:
                 for v in self.config['lvm']['vg']:
@@ -385,13 +3285,7 @@ class Installer:
                 except:
                     pass
             
-            disks_found = []
-            DEV = re.compile('^\/\S+\s+(\/dev\/\w+)\s+')
-            lshw = execute('/usr/sbin/lshw -C disk -short')
-            for i in lshw.splitlines():
-                if DEV.match(i):
-                    disks_found.append(DEV.match(i).group(1))
-            
+            disks_found = self.__disks_found()
             for d in self.config['diskmgmt']['disks']:
                 if not d in disks_found:
                     self.stop_task("failed")
@@ -404,6 +3298,17 @@ class Installer:
             self.__error("Failed to prepare disk(s)")
             raise
     
+    def __disks_found(self):
+        """Disks lshw knows of"""
+        
+        disks_found = []
+        DEV = re.compile('^\/\S+\s+(\/dev\/\w+)\s+')
+        lshw = execute('/usr/sbin/lshw -C disk -short')
+        for i in lshw.splitlines():
+            if DEV.match(i):
+                disks_found.append(DEV.match(i).group(1))
+        return disks_found
+    
     def make_disk_img(self):
         """Create a new VM disk image"""
         
@@ -436,44 +3341,63 @@ class Installer:
             
             os.path.ismount
     
+    def __workers(self):
+        """Max. number of parallel workers (global.workers, 0 = no limit)"""
+        
+        return int(self.config['global'].get('workers', 0)) or None
+    
+    def __format_errors(self, errors):
+        """Format the per-item errors of run_parallel()"""
+        
+        return "; ".join(["%s: %s" % (d, str(errors[d]).strip())
+                          for d in sorted(errors)])
+    
+    def __partition_disk(self, d, echo_str, p_ids):
+        """Partition and wipe a single disk"""
+        
+        execute(command="/sbin/sfdisk %s -uM" % d, input=echo_str)
+        
+        for id in p_ids:
+            execute("/sbin/sfdisk --id %s %d %s" % (d, id, p_ids[id]))
+        execute("/sbin/sfdisk -R %s" % d)
+        
+        wipe = WIPERS[self.config['diskmgmt'].get('wipe', 'signatures')]
+        for id in p_ids:
+            logger.info("Wiping %s (%s)" % (partition_name(d, id),
+                                            wipe.__name__))
+            wipe(partition_name(d, id))
+            try:
+                execute("/sbin/mdadm --zero-superblock %s" %
+                        partition_name(d, id))
+            except:
+                pass
+    
     def partitioning(self):
         """This is how i act on partitions"""
         
+        if self.config['diskmgmt'].get('wipe', 'signatures') not in WIPERS:
+            self.__error("Unknown wipe strategy %s (%s)" %
+                         (self.config['diskmgmt']['wipe'],
+                          ", ".join(sorted(WIPERS))))
+        
         try:
             partitions = self.config['diskmgmt']['partitions']
             self.start_task("Disk partitioning (%s)" %
                             ", ".join(self.config['diskmgmt']['disks']))
-            for d in self.config['diskmgmt']['disks']:
-                echo_str = ""
-                p_id = 1
-                p_ids = {}
-                for p in partitions:
-                    p_ids[p_id] = partitions[p]['type']
-                    if not partitions[p]['size']:
-                        partitions[p]['size'] = ''
-                    echo_str += ",%s\n" % partitions[p]['size']
-                    p_id += 1
-                if len(partitions) < 4:
-                    echo_str += ",\n"
-                echo_str += ";\n"
-                execute(command="/sbin/sfdisk %s -uM" % d, input=echo_str)
-                
-                for id in p_ids:
-                    execute("/sbin/sfdisk --id %s %d %s" % (d, id, p_ids[id]))
-                execute("/sbin/sfdisk -R %s" % d)
-                
-                for id in p_ids:
-                    execute("/bin/dd if=/dev/urandom of=%s%d bs=5k count=1024"
-                            % (d, id))
-                    try:
-                        execute("/sbin/mdadm --zero-superblock %s%d" % (d, p_id))
-                    except:
-                        pass
+            echo_str, p_ids = sfdisk_input(partitions)
             
-            self.stop_task("ok")
+            errors = run_parallel(
+                        lambda d: self.__partition_disk(d, echo_str, p_ids),
+                        self.config['diskmgmt']['disks'], self.__workers())
         except:
             self.stop_task("failed")
             raise
+        
+        if errors:
+            self.stop_task("failed")
+            self.__error("Partitioning failed (%s)" %
+                         self.__format_errors(errors))
+        self.stop_task("ok")
     
     def mdadm(self):
         """Software raid"""
@@ -483,24 +3407,71 @@ class Installer:
             self.stop_task("skip")
             return
         
+        resync = self.config['diskmgmt'].get('resync') or {}
         for p_id in self.config['diskmgmt']['partitions']:
             md_id = p_id - 1
-            devs = ""
+            devs = []
             if os.path.exists("/dev/md%d" % md_id):
                 execute("/sbin/mdadm --stop /dev/md%d" % md_id)
             
             for d in self.config['diskmgmt']['disks']:
-                devs += "%s%d " % (d, p_id)
+                devs.append(partition_name(d, p_id))
                 try:
-                    execute("/sbin/mdadm --zero-superblock %s%d" % (d, p_id))
+                    execute("/sbin/mdadm --zero-superblock %s" %
+                            partition_name(d, p_id))
                 except:
                     pass
             
-            execute("/sbin/mdadm --create --force --metadata=0.90 --verbose \
-                     /dev/md%d --level=1 --auto=yes --raid-devices=2 %s" %
-                     (md_id, devs))
+            execute(mdadm_create_command(md_id, devs,
+                                         resync.get('assume_clean')))
+            self.__tune_resync(md_id, resync)
+        
+        if not resync.get('assume_clean') and not self.md_monitor:
+            self.md_monitor = ResyncMonitor()
+            self.md_monitor.start()
         self.stop_task("ok")
     
+    def __tune_resync(self, md_id, resync):
+        """Freeze (resync: defer) and limit the initial resync, so it
+        doesn't eat the bandwidth of mkfs and the image extract"""
+        
+        if resync.get('defer'):
+            write_sysfs(md_sysfs(md_id, 'sync_action'), "frozen")
+            self.md_deferred.append(md_id)
+        
+        for key in ('speed_min', 'speed_max'):
+            if not resync.get(key):
+                continue
+            path = md_sysfs(md_id, "sync_%s" % key)
+            ## "1000 (system)" follows /proc/sys/dev/raid/speed_limit_*
+            old = open(path).read().split()
+            self.md_saved.setdefault(path, "(system)" in old and "system" or
+                                           old[0])
+            write_sysfs(path, resync[key])
+    
+    def md_resync(self):
+        """Let deferred resyncs run and restore the resync speed limits"""
+        
+        self.start_task("Releasing software raid resync")
+        if not self.md_saved and not self.md_deferred:
+            self.stop_task("skip")
+            return
+        
+        try:
+            self.restore_resync()
+            self.stop_task("ok")
+        except:
+            self.stop_task("failed")
+            raise
+    
+    def restore_resync(self):
+        for md_id in self.md_deferred:
+            write_sysfs(md_sysfs(md_id, 'sync_action'), "idle")
+        for path in sorted(self.md_saved):
+            write_sysfs(path, self.md_saved[path])
+        self.md_deferred = []
+        self.md_saved = {}
+    
     def lvm(self):
         """Logical volume stuff"""
         
@@ -510,19 +3481,37 @@ class Installer:
             return
         
         for v in self.config['lvm']['vg']:
-            vg = self.config['lvm']['vg'][v]
-            for pv in vg['pv']:
-                execute("/sbin/pvcreate -ff -y %s" % pv)
-            execute("/sbin/vgcreate %s %s" % (v, " ".join(vg['pv'])))
-            for lv in vg['lv']:
-                execute("/sbin/lvcreate -n %s -L %s %s" %
-                        (lv, vg['lv'][lv], v))
+            for command in lvm_commands(v, self.config['lvm']['vg'][v]):
+                execute(command)
         
         self.stop_task("ok")
     
-    def filesystems(self):
+    def swap(self):
+        """Create swap space"""
+        
+        self.start_task("Creating swap space")
+        swaps = [fs for fs in sorted(self.config.get('fs', {}))
+                 if fs == "none" or self.config['fs'][fs]['type'] == "swap"]
+        if not swaps:
+            self.stop_task("skip")
+            return
         
-        opts = {"ext2": "-F", "ext3": "-F", "reiserfs": "-f"}
+        ## All mkswap at once, Process does the limiting
+        try:
+            errors = run_parallel(lambda fs: execute("/sbin/mkswap %s" %
+                                  self.config['fs'][fs]['dev']), swaps)
+        except:
+            self.stop_task("failed")
+            raise
+        
+        if errors:
+            self.stop_task("failed")
+            self.__error("mkswap failed (%s)" % self.__format_errors(errors))
+        self.stop_task("ok")
+    
+    def filesystems(self):
+        """Create all filesystems at once (or write their block-level
+        images) and mount them parents first"""
         
         self.start_task("Creating and mounting filesystems")
         if "fs" not in self.config:
@@ -530,43 +3519,395 @@ class Installer:
             self.__error("fs key is missing in config but required!")
             raise
         
+        fs_cfg = self.config['fs']
+        mounts = [fs for fs in fs_cfg
+                  if fs != "none" and fs_cfg[fs]['type'] != "swap"]
+        
+        def mkfs(fs):
+            if fs_cfg[fs].get('image'):
+                self.__write_fs_image(fs_cfg[fs])
+                return
+            execute(mkfs_command(fs_cfg[fs], md_geometry(fs_cfg[fs]['dev'])))
+        
         try:
-            for fs in sorted(self.config['fs']):
-                if fs == "none":
-                    execute("/sbin/mkswap %s" % self.config['fs'][fs]['dev'])
-                    continue
-                stripped_fs = fs.lstrip('/')
-                if not os.path.exists(os.path.join(self.root, stripped_fs)):
-                    os.mkdir(os.path.join(self.root, stripped_fs))
-                execute("/sbin/mkfs.%s %s %s" %
-                        (self.config['fs'][fs]['type'],
-                         opts[self.config['fs'][fs]['type']],
-                         self.config['fs'][fs]['dev']))
-                execute("/bin/mount -t %s %s %s" %
-                        (self.config['fs'][fs]['type'],
-                         self.config['fs'][fs]['dev'],
-                         os.path.join(self.root, stripped_fs)))
-            self.stop_task("ok")
+            ## Rerun after a failed install (see step_consumes)
+            self.__unmount_root()
+            errors = run_parallel(mkfs, mounts, self.__workers())
+            if not errors:
+                errors = self.__mount_filesystems(mounts)
         except:
             self.stop_task("failed")
             raise
+        
+        if errors:
+            self.stop_task("failed")
+            self.__error("Filesystem setup failed (%s)" %
+                         self.__format_errors(errors))
+        self.stop_task("ok")
+    
+    def __mount_filesystems(self, mounts, skip=(), final=False):
+        """Mount filesystems parents first (with the install options of
+        their tuning or the final ones), returns the errors"""
+        
+        def mount(fs):
+            target = os.path.join(self.root, fs.lstrip('/'))
+            if not os.path.exists(target):
+                os.makedirs(target)
+            if final:
+                options = fs_options(self.config['fs'][fs])
+            else:
+                options = fs_tuning(self.config['fs'][fs]).get(
+                                                        'install_options')
+            execute(mount_command(self.config['fs'][fs], target, options))
+        
+        for level in mount_order(mounts):
+            errors = run_parallel(mount, [fs for fs in level
+                                          if fs not in skip],
+                                  self.__workers())
+            if errors:
+                return errors
+        return {}
+    
+    def __write_fs_image(self, fs):
+        """Deploy a block-level image (fs: image, format) instead of mkfs
+        
+        format raw (default) writes the (optionally compressed) image
+        as is, partclone restores a partclone image of the fs type.
+        """
+        
+        decompressor = None
+        compression = compression_of(fs['image'], None)
+        if compression:
+            decompressor = find_decompressor(compression,
+                                self.config['global'].get('decompressor'))
+            if not decompressor:
+                raise UliException("No decompressor for %s" % fs['image'])
+        
+        source, size = self.__open_image(fs['image'])
+        try:
+            if fs.get('format', 'raw') == "partclone":
+                restore = "%s -r -s - -o %s" % (
+                            find_binary("partclone.%s" % fs['type']) or
+                            "partclone.%s" % fs['type'], fs['dev'])
+                execute_stream(source, [c for c in (decompressor, restore)
+                                        if c])
+            else:
+                write_image(source, fs['dev'], decompressor,
+                            fs.get('sparse', False),
+                            zero_copy=fs.get('zero_copy', True))
+            if isinstance(source, VerifyingReader):
+                source.verify()
+        finally:
+            source.close()
+    
+    def __manifest(self, url):
+        """Chunk manifest (<url>.chunks) of an image or None"""
+        
+        r = self.fetcher.open("%s.chunks" % url)
+        data = r.read()
+        self.fetcher.release(r)
+        if r.status != 200:
+            logger.info("No chunk manifest for %s" % url)
+            return None
+        return json.loads(data)
+    
+    def start_reporter(self):
+        """Report to the backend daemon (config section orchestrator)"""
+        
+        if "orchestrator" not in self.config:
+            return
+        
+        cfg = self.config['orchestrator'] or {}
+        self.reporter = Reporter("%s/events/%s" % (self.orchestrator_url,
+                                                   self.mac_escaped),
+                                 cfg.get('interval', 2))
+        timeline.listeners.append(self.reporter.add)
+        self.reporter.start()
+    
+    def stop_reporter(self, state, error=None):
+        if not self.reporter:
+            return
+        if self.reporter.add in timeline.listeners:
+            timeline.listeners.remove(self.reporter.add)
+        self.reporter.stop(state, error)
+        self.reporter = None
+    
+    def acquire_slot(self):
+        """Wait in the queue for an image streaming slot (orchestrator:
+        admission), showing the queue position
+        
+        Without a backend daemon answering, the image is streamed right
+        away.
+        """
+        
+        if not (self.config.get('orchestrator') or {}).get('admission'):
+            return False
+        
+        url = "%s/admission/%s" % (self.orchestrator_url, self.mac_escaped)
+        waiting = False
+        failures = 0
+        try:
+            while True:
+                try:
+                    response = self.fetcher.open(url, "POST")
+                    body = response.read()
+                    self.fetcher.release(response)
+                    if response.status != 200:
+                        logger.warning("No admission control at %s (%d)" %
+                                       (url, response.status))
+                        return False
+                    answer = json.loads(body)
+                    failures = 0
+                except (httplib.HTTPException, socket.error, ValueError), e:
+                    ## A backend busy with a whole rack may be slow, back
+                    ## off before giving up
+                    failures += 1
+                    logger.warning("Admission request failed: %s" % e)
+                    if failures > 5:
+                        return False
+                    time.sleep(min(2 ** failures, 30) * random.uniform(0.5, 1))
+                    continue
+                
+                if answer['granted']:
+                    return True
+                
+                if not waiting:
+                    self.start_task("Waiting for an image streaming slot")
+                    waiting = True
+                self.status("position %d in queue" % (answer['position'] + 1))
+                logger.info("Queued for a streaming slot at position %d" %
+                            (answer['position'] + 1))
+                ## Jitter, or the whole rack asks again at once
+                time.sleep(answer['retry'] * random.uniform(0.8, 1.2))
+        finally:
+            if waiting:
+                self.stop_task(sys.exc_info()[0] and "failed" or "ok")
+    
+    def release_slot(self):
+        url = "%s/admission/%s" % (self.orchestrator_url, self.mac_escaped)
+        try:
+            response = self.fetcher.open(url, "DELETE")
+            response.read()
+            self.fetcher.release(response)
+        except (httplib.HTTPException, socket.error), e:
+            logger.warning("Failed to release the streaming slot: %s" % e)
+    
+    def start_swarm(self):
+        """Join the peer swarm (peers section)"""
+        
+        if self.swarm or "peers" not in self.config:
+            return self.swarm
+        
+        ## Not below the root: the disks are busy with the install and
+        ## remount would pull the spool from under the peer server
+        cfg = self.config['peers'] or {}
+        spool = PEER_SPOOL
+        if self.cache:
+            spool = os.path.join(self.cache.root, 'peers')
+        self.swarm = PeerSwarm(cfg.get('spool', spool),
+                               self.fetcher,
+                               port=cfg.get('port', PEER_PORT),
+                               group=cfg.get('group', PEER_GROUP),
+                               group_port=cfg.get('group_port',
+                                                  PEER_GROUP_PORT),
+                               interface=cfg.get('interface', "0.0.0.0"),
+                               wait=cfg.get('wait', 5))
+        self.swarm.start()
+        return self.swarm
+    
+    def stop_swarm(self):
+        """Serve chunks to the peers for peers.linger seconds and leave"""
+        
+        if not self.swarm:
+            return
+        
+        self.start_task("Serving image chunks to peers")
+        self.swarm.stop((self.config['peers'] or {}).get('linger', 30))
+        self.swarm = None
+        self.stop_task("ok")
+    
+    def __image_url(self, image):
+        return "%s/%s" % (self.config['global'].get('image_url',
+                          self.image_url), image.lstrip('/'))
+    
+    def __checksum(self, image):
+        """Checksum of an image, None if there is none or global.verify
+        is false (true: an image without checksum fails)"""
+        
+        verify = self.config['global'].get('verify')
+        if verify is False:
+            return None
+        
+        if self.config['global'].get('transfer', 'nfs') == "http":
+            checksum = fetch_checksum(self.fetcher, self.__image_url(image))
+        else:
+            checksum = read_checksum("%s/%s" % (self.nfs_mount, image))
+        if not checksum and verify:
+            raise UliException("No checksum for %s" % image)
+        return checksum
+    
+    def __open_image(self, image):
+        """Open the image as file-like object (a VerifyingReader if it has
+        a checksum), returns it with the image size (None if unknown)"""
+        
+        checksum = self.__checksum(image)
+        source, size, key = self.__open_source(image, bool(checksum))
+        if checksum:
+            source = VerifyingReader(source, checksum, image, self.cache,
+                                     key)
+        return source, size
+    
+    def __http_open(self, url, method="GET"):
+        """Request the image at url, returns the response (already read
+        and released for HEAD), the image size (None if unknown) and its
+        cache key"""
+        
+        response = self.fetcher.open(url, method)
+        if method == "HEAD" or response.status != 200:
+            response.read()
+            self.fetcher.release(response)
+        if response.status != 200:
+            raise UliException("Failed to fetch %s: %d %s" %
+                               (url, response.status, response.reason))
+        size = response.getheader('content-length')
+        size = size and int(size)
+        key = "%s|%s|%s" % (url, size, response.getheader('etag') or
+                            response.getheader('last-modified'))
+        return response, size, key
+    
+    def __open_source(self, image, hold=False):
+        """Open the image (cache, peers, HTTP or NFS) as file-like object,
+        returns it with the image size (None if unknown) and its cache key
+        
+        With hold an image read into the cache is only added to it on
+        commit() (see VerifyingReader).
+        """
+        
+        ## With a manifest, only the chunks not in the cache are fetched
+        if self.config['global'].get('transfer', 'nfs') == "http" and \
+           ("peers" in self.config or self.cache):
+            url = self.__image_url(image)
+            manifest = self.__manifest(url)
+        else:
+            manifest = None
+        
+        if manifest and "peers" in self.config:
+            return (self.start_swarm().stream(url, manifest, self.cache),
+                    manifest['size'], None)
+        elif manifest:
+            return (ChunkStream(url, manifest, self.fetcher, self.cache),
+                    manifest['size'], None)
+        elif self.config['global'].get('transfer', 'nfs') == "http":
+            url = self.__image_url(image)
+            ## The cache key only needs the headers, the image is fetched
+            ## on a miss only
+            if self.cache:
+                probe, size, key = self.__http_open(url, "HEAD")
+                cached = self.cache.lookup(key)
+                if cached:
+                    return (open(cached[0], 'rb'),
+                            os.path.getsize(cached[0]), key)
+            source, size, key = self.__http_open(url)
+            source = ResponseStream(self.fetcher, source)
+        else:
+            path = "%s/%s" % (self.nfs_mount, image)
+            source = open(path, 'rb')
+            st = os.fstat(source.fileno())
+            size = st.st_size
+            key = "%s|%d|%d" % (path, size, st.st_mtime)
+        
+        if not self.cache:
+            return source, size, None
+        
+        cached = self.cache.lookup(key)
+        if cached:
+            source.close()
+            return open(cached[0], 'rb'), os.path.getsize(cached[0]), key
+        return self.cache.tee(key, source, size, hold=hold), size, key
     
     def install(self):
+        """Extract the image (cache, NFS or streamed via HTTP) to the
+        target root"""
+        
+        image = self.config['global'].get('image')
+        if not image:
+            self.start_task("Installing image")
+            self.stop_task("skip")
+            return
         
+        decompressor, extract = extract_command(image, self.root,
+                                self.config['global'].get('decompressor'))
+        
+        slot = self.acquire_slot()
         try:
-            self.start_task("Installing %s" % self.config['global']['image'])
-            execute("/bin/tar -C %s -xjSpf %s/%s" % (self.root, self.nfs_mount, self.config['global']['image']))
+            if self.config['global'].get('transfer', 'nfs') == "http":
+                self.start_task("Streaming %s from %s" %
+                                (image.split('/')[-1], self.backend))
+            else:
+                self.start_task("Installing %s" % image)
             
-            #self.start_task("Downloading and installing %s" %
-            #                self.config['global']['image'].split('/')[-1])
-            # 
-            #execute_pipe("/usr/bin/ssh -x install@%s cat %s" %
-            #             (self.backend, self.config['global']['image']),
-            #              "tar -C %s -xjpSf -" % self.root)
+            try:
+                ## NFS too goes through here, to count the bytes for the
+                ## progress
+                source, size = self.__open_image(image)
+                self.progress(0, size)
+                try:
+                    if decompressor:
+                        execute_stream(source, [decompressor, extract],
+                                       progress=self.progress)
+                    else:
+                        execute_stream(source, "%s -" % extract,
+                                       progress=self.progress)
+                    ## Fails the install, so grub never makes a host
+                    ## with a broken image bootable
+                    if isinstance(source, VerifyingReader):
+                        source.verify()
+                finally:
+                    source.close()
+            except:
+                self.stop_task("failed")
+                raise
             self.stop_task("ok")
+        finally:
+            if slot:
+                self.release_slot()
+    
+    def remount(self):
+        """Mount tuned filesystems with their final options (data= and
+        friends can't be changed by mount -o remount)"""
+        
+        self.start_task("Remounting filesystems with final options")
+        if not [fs for fs in self.config['fs']
+                if fs != "none" and fs_tuning(self.config['fs'][fs])]:
+            self.stop_task("skip")
+            return
+        
+        try:
+            self.__remount()
         except:
             self.stop_task("failed")
             raise
+        self.stop_task("ok")
+    
+    def __unmount_root(self):
+        """Unmount everything below the root, deepest first: after a
+        failed install proc and sys (mount_pseudo) are still mounted"""
+        
+        root = os.path.normpath(self.root)
+        below = [m for m in mountpoints()
+                 if m == root or m.startswith(root.rstrip('/') + '/')]
+        for target in sorted(below, key=len, reverse=True):
+            execute("/bin/umount %s" % target)
+    
+    def __remount(self):
+        mounts = [fs for fs in self.config['fs'] if fs != "none" and
+                  self.config['fs'][fs]['type'] != "swap"]
+        self.__unmount_root()
+        
+        errors = self.__mount_filesystems(mounts, final=True)
+        if errors:
+            raise UliException("Remount failed (%s)" %
+                               self.__format_errors(errors))
     
     def mount_pseudo(self):
         
@@ -622,14 +3963,11 @@ class Installer:
         c = open("%s/etc/fstab" % self.root, 'w')
         c.write("## Created by U.L.I.\n\n")
         for fs in sorted(self.config['fs']):
-            default_opts = "noatime"
-            if self.config['fs'][fs]['type'] == "swap":
-                default_opts = "sw"
             c.write("%s\t\t%s\t%s\t%s\t0 0\n" %
                     (self.config['fs'][fs]['dev'],
                      fs,
                      self.config['fs'][fs]['type'],
-                     default_opts))
+                     fs_options(self.config['fs'][fs])))
         c.write("\nshm\t/dev/shm\ttmpfs\tnodev,nosuid,noexec\t0 0\n")
         c.write("proc\t/proc\tproc\tdefaults\t0 0\n")
         c.write("sysfs\t/sys\tsysfs\tnosuid,nodev,noexec,relatime\t0 0\n")
@@ -648,28 +3986,107 @@ class Installer:
         """Install grub"""
         
         self.start_task("Installing GRUB bootloader")
-        c = 0
-        for d in self.config['diskmgmt']['disks']:
+        disks = self.config['diskmgmt']['disks']
+        
+        def setup(d):
             execute(command="/sbin/grub --batch --no-curses --no-floppy",
-                    input="find /boot/grub/stage1\ndevice (hd%d) %s\nroot \
-                          (hd%d,0)\nsetup (hd%d)\nquit\n" % (c, d, c, c))
-            c += 1
+                    input=grub_input(list(disks).index(d), d))
+        
+        errors = run_parallel(setup, disks, self.__workers())
+        if errors:
+            self.stop_task("failed")
+            self.__error("GRUB setup failed (%s)" % self.__format_errors(errors))
         self.stop_task("ok")
     
+    def resume_verify_disks(self):
+        """Only check the disks, md arrays and VGs stay active"""
+        
+        disks_found = self.__disks_found()
+        return not [d for d in self.config['diskmgmt']['disks']
+                    if d not in disks_found]
+    
+    def resume_partitioning(self):
+        return not [p for p in self.config['diskmgmt']['partitions']
+                    for d in self.config['diskmgmt']['disks']
+                    if not os.path.exists(partition_name(d, p))]
+    
+    def resume_mdadm(self):
+        """Assemble the arrays that aren't running"""
+        
+        if self.config['diskmgmt']['type'] != "md":
+            return True
+        
+        mdstat = open('/proc/mdstat').read()
+        for p_id in self.config['diskmgmt']['partitions']:
+            if re.search(r'^md%d : active' % (p_id - 1), mdstat, re.M):
+                continue
+            execute("/sbin/mdadm --assemble /dev/md%d %s" %
+                    (p_id - 1, " ".join([partition_name(d, p_id) for d in
+                                         self.config['diskmgmt']['disks']])))
+        return True
+    
+    def resume_lvm(self):
+        """Activate the VGs"""
+        
+        if "lvm" not in self.config:
+            return True
+        
+        vgs = self.config['lvm']['vg']
+        for v in vgs:
+            execute("/sbin/vgchange -ay %s" % v)
+        return not [lv for v in vgs for lv in vgs[v]['lv']
+                    if not os.path.exists("/dev/%s/%s" % (v, lv))]
+    
+    def resume_swap(self):
+        return not [fs for fs in self.config['fs']
+                    if (fs == "none" or
+                        self.config['fs'][fs]['type'] == "swap") and
+                    not os.path.exists(self.config['fs'][fs]['dev'])]
+    
+    def resume_filesystems(self):
+        """Mount what isn't mounted yet"""
+        
+        mounted = mountpoints()
+        mounts = [fs for fs in self.config['fs']
+                  if fs != "none" and self.config['fs'][fs]['type'] != "swap"]
+        skip = [fs for fs in mounts if os.path.normpath(
+                    os.path.join(self.root, fs.lstrip('/'))) in mounted]
+        errors = self.__mount_filesystems(mounts, skip)
+        if errors:
+            raise UliException(self.__format_errors(errors))
+        return True
+    
+    def resume_remount(self):
+        """resume_filesystems mounted with the install options"""
+        
+        if [fs for fs in self.config['fs']
+            if fs != "none" and fs_tuning(self.config['fs'][fs])]:
+            self.__remount()
+        return True
+    
+    def resume_mount_pseudo(self):
+        mounted = mountpoints()
+        for fs, type, source in (('proc', 'proc', '/proc'),
+                                 ('sys', 'sysfs', '/sys')):
+            if os.path.join(self.root, fs) not in mounted:
+                if not os.path.exists(os.path.join(self.root, fs)):
+                    os.mkdir(os.path.join(self.root, fs))
+                execute("/bin/mount -t %s -o bind %s %s" %
+                        (type, source, os.path.join(self.root, fs)))
+        return True
+    
     def plugins(self):
         """Download and run plugins"""
         
         self.start_task("Downloading plugins")
-        if self.__url_exists(self.plugin_url):
-            try:
-                if not self.__url_fetch(self.plugin_url, self.local_plugin):
-                    self.stop_task("failed")
-                    self.__error("Failed to download %s" % self.download_url)
-                    raise
+        try:
+            if self.fetcher.fetch(self.plugin_url, self.local_plugin):
                 self.stop_task("ok")
-            except:
-                self.stop_task("failed")
-                raise
+            else:
+                self.stop_task("skip")
+        except:
+            self.stop_task("failed")
+            raise
     
     def byebye(self):
         """Say bye bye"""
@@ -0,0 +1,485 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""U.L.I. backend daemon: serves configs and images, watches the fleet
+
+Serves the backend directory (U.L.I./ with the configs, images/) over
+HTTP with range support and conditional GETs (ETag, Last-Modified),
+like the static backend it replaces. On top of that, installers with an
+'orchestrator' config section talk to it:
+
+  POST   /orchestrator/events/<mac>     timeline events and progress
+  POST   /orchestrator/admission/<mac>  ask for an image streaming slot
+  DELETE /orchestrator/admission/<mac>  give the slot back
+  GET    /orchestrator/config/<mac>     config of a host (or fallback)
+  GET    /orchestrator/fleet            state of all hosts (JSON)
+
+At most --slots hosts stream their image at once. The others queue up
+in the order they asked (FIFO) and are told their position and when to
+ask again, the further back the longer. A slot of a host which sent
+nothing for --slot-timeout seconds is freed, a queued host that stopped
+asking drops out of the queue. --bandwidth caps the total rate of all
+downloads (token bucket shared by all connections).
+
+A prevalidated config (<mac>.json by validate.py) whose YAML changed
+since is not served, installers get the YAML instead.
+
+Usage: backend.py [options] <backend dir>
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import optparse
+import threading
+import email.utils
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+import ULI
+
+FALLBACK = "00_00_00_00_00_01"
+MAC = re.compile(r'^[0-9a-f]{2}(_[0-9a-f]{2}){5}$')
+
+
+## Longest time a queued host is told to wait before asking again
+MAX_RETRY = 30
+
+
+def parse_range(header, size):
+    """(start, end) of a single byte range, None to send everything
+    (no, multiple or invalid ranges), False if not satisfiable"""
+
+    m = re.match(r'^bytes=(\d*)-(\d*)$', (header or "").strip())
+    if not m or not m.group(1) and not m.group(2):
+        return None
+    if not m.group(1):
+        ## Suffix range: the last n bytes
+        n = int(m.group(2))
+        if not n or not size:
+            return False
+        return max(size - n, 0), size - 1
+    start = int(m.group(1))
+    end = size - 1
+    if m.group(2):
+        end = int(m.group(2))
+    if end < start and m.group(2):
+        return None
+    if start >= size:
+        return False
+    return start, min(end, size - 1)
+
+
+class TokenBucket:
+    """Bandwidth limit shared by threads: take(n) blocks until n more
+    bytes may be sent at rate bytes/s"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        ## 100ms worth by default
+        self.burst = burst or self.rate / 10
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            ## Going into debt queues the callers up in order
+            self.tokens -= n
+            wait = self.tokens < 0 and -self.tokens / self.rate or 0
+        if wait:
+            time.sleep(wait)
+
+
+class Fleet:
+    """State of all installing hosts and the admission slots"""
+
+    def __init__(self, slots=0, slot_timeout=600):
+        self.slots = slots
+        self.slot_timeout = slot_timeout
+        self.hosts = {}
+        ## mac => time the slot was granted
+        self.holders = {}
+        ## macs waiting for a slot, first come first served
+        self.queue = []
+        self.lock = threading.Lock()
+
+    def __host(self, mac, address=None):
+        host = self.hosts.setdefault(mac, {'mac': mac, 'state': "new",
+                                           'step': None, 'address': None,
+                                           'first_seen': time.time(),
+                                           'events': 0, 'bytes': 0,
+                                           'total': None, 'throughput': 0.0,
+                                           'error': None})
+        host['last_seen'] = time.time()
+        if address:
+            host['address'] = address
+        return host
+
+    def seen(self, mac, address=None, state=None):
+        with self.lock:
+            host = self.__host(mac, address)
+            if state:
+                host['state'] = state
+
+    def events(self, mac, events, address=None):
+        """Update the host from its timeline events"""
+
+        with self.lock:
+            host = self.__host(mac, address)
+            host['events'] += len(events)
+            for e in events:
+                if e.get('kind') == "step":
+                    host['step'] = e['name']
+                    if e.get('rc') == "failed":
+                        host['state'] = "failed"
+                    elif host['state'] not in ("failed", "done"):
+                        host['state'] = "installing"
+                elif e.get('kind') == "progress":
+                    self.__progress(host, e)
+                elif e.get('kind') == "state":
+                    host['state'] = e['name']
+                    host['error'] = e.get('rc')
+
+            if host['state'] in ("done", "failed"):
+                self.holders.pop(mac, None)
+                if mac in self.queue:
+                    self.queue.remove(mac)
+
+    def __progress(self, host, e):
+        """Throughput (smoothed) from the bytes done at e['time']"""
+
+        last = host.get('progress_at')
+        if last and e['time'] > last and e['size'] >= host['bytes']:
+            rate = (e['size'] - host['bytes']) / (e['time'] - last)
+            host['throughput'] = round(0.7 * rate + 0.3 * host['throughput'],
+                                       1)
+        host['bytes'] = e['size']
+        host['total'] = e.get('total')
+        host['progress_at'] = e['time']
+
+    def admit(self, mac):
+        """Grant a slot or queue mac, returns (granted, queue position,
+        seconds until asking again)"""
+
+        with self.lock:
+            self.__host(mac)
+            self.__expire()
+
+            if mac in self.holders:
+                return True, 0, 0
+            if mac not in self.queue:
+                self.queue.append(mac)
+
+            position = self.queue.index(mac)
+            if not self.slots or position < self.slots - len(self.holders):
+                self.queue.remove(mac)
+                self.holders[mac] = time.time()
+                self.hosts[mac]['state'] = "streaming"
+                return True, 0, 0
+
+            self.hosts[mac]['state'] = "waiting"
+            self.hosts[mac]['position'] = position
+            ## Backoff by distance to the head of the queue
+            return False, position, min(1 + position / 2.0, MAX_RETRY)
+
+    def __expire(self):
+        now = time.time()
+        for holder in list(self.holders):
+            if now - self.hosts[holder]['last_seen'] > self.slot_timeout:
+                ULI.logger.warning("Slot of %s timed out" % holder)
+                del self.holders[holder]
+        for mac in list(self.queue):
+            if now - self.hosts[mac]['last_seen'] > 3 * MAX_RETRY:
+                ULI.logger.warning("%s left the queue" % mac)
+                self.queue.remove(mac)
+
+    def release(self, mac):
+        with self.lock:
+            self.holders.pop(mac, None)
+            if mac in self.queue:
+                self.queue.remove(mac)
+
+    def snapshot(self):
+        with self.lock:
+            states = {}
+            for host in self.hosts.values():
+                states[host['state']] = states.get(host['state'], 0) + 1
+            return {'time': time.time(),
+                    'slots': {'total': self.slots,
+                              'used': len(self.holders),
+                              'holders': sorted(self.holders)},
+                    'queue': list(self.queue),
+                    'states': states,
+                    'throughput': round(sum([h['throughput'] for h in
+                                             self.hosts.values()
+                                             if h['state'] == "streaming"]),
+                                        1),
+                    'hosts': dict([(mac, dict(self.hosts[mac]))
+                                   for mac in self.hosts])}
+
+
+class Backend(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server of a backend directory (root)"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+    def __init__(self, address, root, fleet=None, bandwidth=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.root = root
+        self.fleet = fleet or Fleet()
+        self.bucket = bandwidth and TokenBucket(bandwidth)
+        ## (json, mtimes and size) => prevalidated config is current
+        self.checked = {}
+
+    def current_config(self, path):
+        """False for a prevalidated config (validate.py) whose YAML was
+        changed (or removed) since"""
+
+        yaml_path = "%s.yaml" % os.path.splitext(path)[0]
+        try:
+            st = os.stat(yaml_path)
+            key = (path, os.path.getmtime(path), st.st_mtime, st.st_size)
+        except OSError:
+            return False
+
+        if key not in self.checked:
+            digest = hashlib.sha256(open(yaml_path).read()).hexdigest()
+            try:
+                compiled = json.load(open(path)).get('sha256')
+            except (IOError, ValueError):
+                compiled = None
+            if compiled != digest:
+                ULI.logger.warning("Not serving stale %s" % path)
+            self.checked[key] = compiled == digest
+        return self.checked[key]
+
+
+class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def translate_path(self, path):
+        path = os.path.normpath(path.split('?')[0]).lstrip('/')
+        if path.startswith('..'):
+            return None
+        return os.path.join(self.server.root, path)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        return length and self.rfile.read(length) or ""
+
+    def route(self):
+        """(action, mac) of an orchestrator request, else None"""
+
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) < 2 or parts[0] != "orchestrator":
+            return None
+        mac = len(parts) > 2 and parts[2].lower() or None
+        if mac and not MAC.match(mac):
+            return parts[1], None
+        return parts[1], mac
+
+    def do_GET(self):
+        route = self.route()
+        if route == ("fleet", None):
+            self.send_json(self.server.fleet.snapshot())
+        elif route and route[0] == "config" and route[1]:
+            self.send_config(route[1])
+        elif route:
+            self.send_error(404)
+        else:
+            self.send_file(self.translate_path(self.path))
+
+    def do_HEAD(self):
+        self.send_file(self.translate_path(self.path), head=True)
+
+    def do_POST(self):
+        route = self.route()
+        if not route or not route[1]:
+            self.send_error(404)
+            return
+
+        fleet = self.server.fleet
+        address = self.client_address[0]
+        if route[0] == "events":
+            try:
+                events = json.loads(self.read_body())
+            except ValueError:
+                self.send_error(400)
+                return
+            fleet.events(route[1], events, address)
+            self.send_json({'ok': True})
+        elif route[0] == "admission":
+            self.read_body()
+            fleet.seen(route[1], address)
+            granted, position, retry = fleet.admit(route[1])
+            self.send_json({'granted': granted, 'position': position,
+                            'retry': retry})
+        else:
+            self.send_error(404)
+
+    def do_DELETE(self):
+        route = self.route()
+        if not route or route[0] != "admission" or not route[1]:
+            self.send_error(404)
+            return
+        self.server.fleet.release(route[1])
+        self.send_json({'ok': True})
+
+    def send_config(self, mac):
+        """Host config (prevalidated JSON first) or the fallback"""
+
+        for name in (mac, FALLBACK):
+            for ext in ("json", "yaml"):
+                path = os.path.join(self.server.root, "U.L.I.",
+                                    "%s.%s" % (name, ext))
+                if os.path.isfile(path) and \
+                   (ext == "yaml" or self.server.current_config(path)):
+                    self.server.fleet.seen(mac, self.client_address[0],
+                                           "config")
+                    self.send_file(path, headers={'X-ULI-Config':
+                                                  os.path.basename(path)})
+                    return
+        self.send_error(404)
+
+    def send_file(self, path, head=False, headers=None):
+        if not path or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        ## Installers fetching their own config, a stale prevalidated one
+        ## makes them fall back to the YAML
+        name, ext = os.path.splitext(os.path.basename(path))
+        if MAC.match(name) and ext == ".json" and \
+           not self.server.current_config(path):
+            self.send_error(404)
+            return
+        if MAC.match(name) and name != FALLBACK:
+            self.server.fleet.seen(name, self.client_address[0], "config")
+
+        st = os.stat(path)
+        size = st.st_size
+        etag = '"%x-%x"' % (int(st.st_mtime * 1000000), size)
+        validators = {'ETag': etag,
+                      'Last-Modified': self.date_time_string(st.st_mtime)}
+
+        ## Conditional GETs of the installers (Fetcher.fetch)
+        if self.not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            for h in validators:
+                self.send_header(h, validators[h])
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        byte_range = parse_range(self.headers.getheader('Range'), size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', "bytes */%d" % size)
+            self.send_header('Content-Length', "0")
+            self.end_headers()
+            return
+        elif byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', "bytes")
+        for h in validators:
+            self.send_header(h, validators[h])
+        for h in headers or {}:
+            self.send_header(h, headers[h])
+        self.end_headers()
+        if head:
+            return
+
+        ## Small blocks when shaping, for an even rate
+        block = ULI.CHUNK_SIZE
+        if self.server.bucket:
+            block = int(max(min(block, self.server.bucket.rate / 20), 4096))
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                data = f.read(min(block, left))
+                if not data:
+                    break
+                if self.server.bucket:
+                    self.server.bucket.take(len(data))
+                self.wfile.write(data)
+                left -= len(data)
+
+    def not_modified(self, etag, mtime):
+        """Do the If-None-Match/If-Modified-Since headers match?"""
+
+        none_match = self.headers.getheader('If-None-Match')
+        if none_match:
+            return none_match.strip() == "*" or \
+                   etag in [t.strip() for t in none_match.split(',')]
+
+        since = self.headers.getheader('If-Modified-Since')
+        if since:
+            parsed = email.utils.parsedate_tz(since)
+            return bool(parsed) and \
+                   int(mtime) <= email.utils.mktime_tz(parsed)
+        return False
+
+    def log_message(self, format, *args):
+        ULI.logger.info("backend: %s %s" % (self.client_address[0],
+                                            format % args))
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option("--listen", default="0.0.0.0",
+                      help="address to listen on [%default]")
+    parser.add_option("--port", type="int", default=80,
+                      help="port to listen on [%default]")
+    parser.add_option("--slots", type="int", default=0,
+                      help="hosts streaming images at once (0: no limit) "
+                           "[%default]")
+    parser.add_option("--slot-timeout", type="int", default=600,
+                      help="free slots of hosts silent this long (seconds) "
+                           "[%default]")
+    parser.add_option("--bandwidth", type="float", default=0,
+                      help="total download rate in MB/s (0: no limit) "
+                           "[%default]")
+    options, args = parser.parse_args()
+
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error("no backend directory given")
+
+    server = Backend((options.listen, options.port), args[0],
+                     Fleet(options.slots, options.slot_timeout),
+                     options.bandwidth * 1024 ** 2)
+    print("Serving %s on %s:%d (%s slots, %s MB/s)" %
+          (args[0], options.listen, options.port, options.slots or "no",
+           options.bandwidth or "unlimited"))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
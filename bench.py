@@ -0,0 +1,303 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""Benchmark the U.L.I. install pipeline on loop devices
+
+Runs the Installer steps against loop-backed disk files instead of real
+disks. A local backend.py server serves the generated config and a
+generated test image. Every variant (serial, parallel, ...) starts from
+fresh disks, and the per-step timings of all variants are reported side
+by side.
+
+Needs root and creates md arrays (md0..md2), so only run it on a test
+box. The image is always streamed via HTTP because there is no NFS
+backend.
+
+With --raw-write only the raw image path (ULI.write_image) is timed:
+an uncompressed image of that many MB is written to the first loop disk
+from the HTTP socket, the image file and a pipe, each with and without
+zero copy.
+
+Usage: bench.py [options]
+"""
+
+import os
+import time
+import json
+import yaml
+import shutil
+import tempfile
+import threading
+import optparse
+
+from subprocess import Popen, PIPE
+
+import ULI
+import backend as uli_backend
+
+DEFAULT_STEPS = "partitioning,mdadm,lvm,swap,filesystems,install,md_resync,\
+remount"
+
+## Config overrides of the benchmarked variants
+VARIANTS = {'serial': {'global': {'scheduler': 'serial', 'workers': 1,
+                                  'decompressor': 'tar'},
+                       'diskmgmt': {'wipe': 'urandom'}},
+            'parallel': {'global': {'scheduler': 'parallel', 'workers': 0},
+                         'diskmgmt': {'wipe': 'signatures'}},
+            'noresync': {'global': {'scheduler': 'parallel', 'workers': 0},
+                         'diskmgmt': {'wipe': 'signatures',
+                                      'resync': {'assume_clean': True}}},
+            'tuned': {'global': {'scheduler': 'parallel', 'workers': 0},
+                      'diskmgmt': {'wipe': 'signatures'},
+                      'fs': {'/boot': {'tuning': 'fast'},
+                             '/': {'tuning': 'fast'}}},
+           }
+
+
+def make_image(workdir, files, file_size, compression):
+    """Build a test image with a minimal system skeleton"""
+
+    tree = os.path.join(workdir, 'tree')
+    for d in ('etc/init.d', 'etc/conf.d', 'boot/grub', 'usr/share/bench'):
+        os.makedirs(os.path.join(tree, d))
+    open(os.path.join(tree, 'etc/init.d/net.lo'), 'w').close()
+
+    ## Half random, half zeros: something for the decompressor to do
+    for i in range(files):
+        with open(os.path.join(tree, 'usr/share/bench', "%06d" % i),
+                  'wb') as f:
+            f.write(os.urandom(file_size / 2) + "\0" * (file_size / 2))
+
+    suffix = {'bz2': 'tar.bz2', 'gz': 'tar.gz', 'xz': 'tar.xz',
+              'zst': 'tar.zst'}[compression]
+    image = os.path.join(workdir, 'www/images', "bench.%s" % suffix)
+    os.makedirs(os.path.dirname(image))
+    compressor = ULI.find_decompressor(compression).replace(' -dc', ' -c')
+
+    with open(image, 'wb') as f:
+        tar = Popen(["/bin/tar", "-C", tree, "-cf", "-", "."], stdout=PIPE)
+        comp = Popen(compressor.split(), stdin=tar.stdout, stdout=f)
+        tar.stdout.close()
+        comp.wait()
+        tar.wait()
+    if tar.returncode or comp.returncode:
+        raise Exception("Failed to build %s" % image)
+
+    shutil.rmtree(tree)
+    return image
+
+
+def bench_raw(workdir, dev, backend, size):
+    """Time write_image per source, with and without zero copy"""
+
+    image = os.path.join(workdir, 'www/images', "raw.img")
+    if not os.path.isdir(os.path.dirname(image)):
+        os.makedirs(os.path.dirname(image))
+    with open(image, 'wb') as f:
+        for i in range(size):
+            f.write(os.urandom(1024 * 1024))
+
+    fetcher = ULI.Fetcher()
+    print("\n%-8s %12s %12s" % ("Source", "zero copy", "buffered"))
+    for source in ("http", "file", "pipe"):
+        row = []
+        for zero_copy in (True, False):
+            ## Nothing of the previous run left to flush
+            ULI.execute("/bin/sync")
+            if source == "http":
+                f = ULI.ResponseStream(fetcher, fetcher.open(
+                                "http://%s/images/raw.img" % backend))
+            else:
+                f = open(image, 'rb')
+            start = time.time()
+            try:
+                total = ULI.write_image(f, dev, source == "pipe" and
+                                        ULI.find_binary("cat") or None,
+                                        zero_copy=zero_copy)
+            finally:
+                f.close()
+            row.append(total / 1024.0 ** 2 / (time.time() - start))
+        print("%-8s %7.1f MB/s %7.1f MB/s" % (source, row[0], row[1]))
+    fetcher.close()
+
+
+def make_config(disks, image, md=True):
+    """Config for the loop disks: /boot, swap and / on md (or plain)"""
+
+    ptype = md and "fd" or "83"
+    devs = []
+    for p in (1, 2, 3):
+        if md:
+            devs.append("/dev/md%d" % (p - 1))
+        else:
+            devs.append(ULI.partition_name(disks[0], p))
+
+    return {'global': {'image': os.path.basename(image),
+                       'hostname': 'bench', 'domainname': 'example.com',
+                       'interactive': False, 'transfer': 'http'},
+            'diskmgmt': {'type': md and "md" or "plain", 'disks': disks,
+                         'partitions': {1: {'size': 64, 'type': ptype},
+                                        2: {'size': 128, 'type': ptype},
+                                        3: {'size': None, 'type': ptype}}},
+            'fs': {'/boot': {'dev': devs[0], 'type': 'ext2'},
+                   'none': {'dev': devs[1], 'type': 'swap'},
+                   '/': {'dev': devs[2], 'type': 'ext3'}},
+           }
+
+
+def merge(config, overrides):
+    """Deep-merge overrides into a copy of config"""
+
+    config = dict(config)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key] = merge(config[key], value)
+        else:
+            config[key] = value
+    return config
+
+
+def teardown(root, config):
+    """Unmount and stop everything a run left behind"""
+
+    mounts = [l.split()[1] for l in open('/proc/mounts')
+              if l.split()[1].startswith(root)]
+    for m in sorted(mounts, key=len, reverse=True):
+        ULI.execute("/bin/umount %s" % m)
+
+    if config['diskmgmt']['type'] == "md":
+        for p in config['diskmgmt']['partitions']:
+            if os.path.exists("/dev/md%d" % (p - 1)):
+                ULI.execute("/sbin/mdadm --stop /dev/md%d" % (p - 1))
+
+
+def run(name, config, workdir, backend, steps):
+    """Run the steps of one variant, returns its timeline"""
+
+    root = os.path.join(workdir, 'root')
+    if not os.path.isdir(root):
+        os.mkdir(root)
+
+    www = os.path.join(workdir, 'www', 'U.L.I.')
+    if not os.path.isdir(www):
+        os.makedirs(www)
+    with open(os.path.join(www, 'bench.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+
+    ULI.timeline = ULI.Timeline()
+    U = ULI.Installer(root=root, backend=backend, mac="bench",
+                      local_config=os.path.join(workdir, 'uli.yaml'))
+    U.cache = None
+
+    print("\n== %s" % name)
+    try:
+        U.step('download_config')
+        U.step('parse_config')
+        U.run_steps(only=steps)
+    finally:
+        if U.md_monitor:
+            U.md_monitor.stop()
+        teardown(root, config)
+
+    return ULI.timeline
+
+
+def report(timelines, steps):
+    """Print the step durations of all variants side by side"""
+
+    names = sorted(timelines)
+    print("\n%-16s %s" % ("Step", " ".join(["%12s" % n for n in names])))
+    for step in steps + ['total']:
+        row = []
+        for n in names:
+            events = [e for e in timelines[n].events
+                      if e['kind'] == "step" and e['name'] in steps and
+                      (step == "total" or e['name'] == step)]
+            if step == "total" and events:
+                row.append(max([e['start'] + e['duration'] for e in events]) -
+                           min([e['start'] for e in events]))
+            else:
+                row.append(sum([e['duration'] for e in events]))
+        print("%-16s %s" % (step, " ".join(["%12.2f" % r for r in row])))
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option("--variants", default="serial,parallel",
+                      help="variants to run (%s)" % ", ".join(VARIANTS))
+    parser.add_option("--steps", default=DEFAULT_STEPS,
+                      help="installer steps to time [%default]")
+    parser.add_option("--disks", type="int", default=2,
+                      help="number of loop disks [%default]")
+    parser.add_option("--disk-size", type="int", default=2048,
+                      help="size of every loop disk in MB [%default]")
+    parser.add_option("--plain", action="store_true",
+                      help="no md raid, filesystems on the first disk")
+    parser.add_option("--files", type="int", default=2000,
+                      help="number of files in the test image [%default]")
+    parser.add_option("--file-size", type="int", default=64 * 1024,
+                      help="size of every file in the image [%default]")
+    parser.add_option("--compression", default="bz2",
+                      help="image compression (bz2, gz, xz, zst) [%default]")
+    parser.add_option("--repeat", type="int", default=1,
+                      help="runs per variant [%default]")
+    parser.add_option("--raw-write", type="int", metavar="MB",
+                      help="only time raw image writes of MB to a loop disk")
+    parser.add_option("--json", help="write all timelines to this file")
+    parser.add_option("--workdir", help="keep files here (default: tmp)")
+    options, args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        parser.error("loop devices, md and mounts need root")
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="uli-bench-")
+    steps = options.steps.split(',')
+    loops = []
+
+    server = uli_backend.Backend(('127.0.0.1', 0),
+                                 os.path.join(workdir, 'www'))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    backend = "127.0.0.1:%d" % server.server_address[1]
+
+    try:
+        for i in range(options.disks):
+            disk = os.path.join(workdir, "disk%d.img" % i)
+            with open(disk, 'wb') as f:
+                f.truncate(options.disk_size * 1024 * 1024)
+            loops.append(ULI.execute("/sbin/losetup --find --show -P %s" %
+                                     disk).strip())
+
+        if options.raw_write:
+            bench_raw(workdir, loops[0], backend, options.raw_write)
+            return
+
+        print("Building test image (%d x %d bytes)" % (options.files,
+                                                       options.file_size))
+        image = make_image(workdir, options.files, options.file_size,
+                           options.compression)
+        config = make_config(loops, image, not options.plain)
+
+        timelines = {}
+        for name in options.variants.split(','):
+            for i in range(options.repeat):
+                label = options.repeat > 1 and "%s#%d" % (name, i) or name
+                timelines[label] = run(label, merge(config, VARIANTS[name]),
+                                       workdir, backend, steps)
+
+        report(timelines, steps)
+
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(dict([(n, timelines[n].events) for n in timelines]),
+                          f, indent=1)
+    finally:
+        server.shutdown()
+        for l in loops:
+            ULI.execute("/sbin/losetup -d %s" % l)
+        if not options.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""Create the chunk manifest (<image>.chunks) of U.L.I. images
+
+Installers with a 'peers' config section use the manifest to fetch the
+image chunk by chunk from each other instead of the backend. Installers
+with a 'cache' section keep the chunks and on the next install only
+fetch the chunks they don't have yet.
+
+With --cdc the chunk boundaries depend on the content, so a new version
+of an image shares most chunks with the old one. This only works for
+images whose bytes change locally when files change: uncompressed
+tarballs, or compressed with gzip --rsyncable / zstd --rsyncable. It is
+also much slower (about 0.1 s per MB) than fixed size chunks.
+
+Usage: chunks.py [options] <image> [<image> ...]
+"""
+
+import os
+import json
+import optparse
+
+import ULI
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option("--cdc", action="store_true",
+                      help="content defined chunks (for delta updates)")
+    parser.add_option("--chunk-size", type="int",
+                      help="chunk size (average with --cdc) in KB "
+                           "[%d, cdc: %d]" % (ULI.CHUNK_IMAGE / 1024,
+                                              ULI.CDC_AVG / 1024))
+    options, args = parser.parse_args()
+
+    if not args:
+        parser.error("no image given")
+
+    for image in args:
+        manifest = ULI.make_manifest(image, options.chunk_size and
+                                     options.chunk_size * 1024, options.cdc)
+        with open("%s.chunks.part" % image, 'w') as f:
+            json.dump(manifest, f)
+        os.rename("%s.chunks.part" % image, "%s.chunks" % image)
+        print("%s: %d bytes, %d chunks" % (image, manifest['size'],
+                                           len(manifest['chunks'])))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,6 @@
 import os
 import sys
 import time
-import urllib
-import urllib2
 
 from termcolor import colored
 import ULI
@@ -36,31 +34,22 @@ U = ULI.Installer()
 ########################################
 
 try:
-    U.start_task("Connection to backend server %s/" % U.download_url)
-    r = urllib2.urlopen("%s/ULI.py" % U.download_url)
-    U.stop_task("ok")
-except urllib2.URLError as e:
-    U.stop_task("failed")
-    if not hasattr(e, "code"):
-        raise
-    else:
-        U.stop_task("failed")
-        U._error("Failed to download ULI.py update: %s" % e)
-        raise
-
-try:
-    U.start_task("Self-updating U.L.I. from backend")
-    dl = urllib.urlretrieve("%s/ULI_2.py" % U.download_url,
-                            os.path.join(os.path.dirname(__file__),
-                                         'ULI_UPDATE.py'))
-    if not os.path.exists(dl[0]):
-        U.stop_task("failed")
-        U._error("Failed to download ULI.py")
-    else:
-        U.stop_task("ok")
+    U.start_task("Self-updating U.L.I. from backend %s/" % U.download_url)
+    ## Verified against ULI_2.py.sha256 if the backend has one
+    downloaded = U.fetcher.fetch("%s/ULI_2.py" % U.download_url,
+                                 os.path.join(os.path.dirname(__file__),
+                                              'ULI_UPDATE.py'),
+                                 verify=True)
 except:
+    U.stop_task("failed")
     raise
 
+if not downloaded:
+    U.stop_task("failed")
+    raise ULI.UliException("Failed to download ULI.py")
+else:
+    U.stop_task("ok")
+
 import ULI_UPDATE
 UPDATE_VERSION = ULI_UPDATE.VERSION
 
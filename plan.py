@@ -0,0 +1,66 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""Show what U.L.I. would do with a config, without touching any disk
+
+Compiles every given YAML config into the ordered, dependency-annotated
+list of install commands (see ULI.Planner). Invalid configs are reported
+and make the exit code non-zero, so this can check configs in CI.
+
+Usage: plan.py [options] <config.yaml> [<config.yaml> ...]
+"""
+
+import os
+import sys
+import json
+import yaml
+import optparse
+
+import ULI
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option("--json", action="store_true",
+                      help="dump the plans as JSON")
+    parser.add_option("--image-dir",
+                      help="look up image sizes here (e.g. the NFS share)")
+    parser.add_option("--root", default="/install",
+                      help="target root of the install [%default]")
+    options, args = parser.parse_args()
+
+    if not args:
+        parser.error("no config given")
+
+    plans = {}
+    failed = False
+    for path in args:
+        try:
+            config = yaml.load(open(path), Loader=ULI.ConfigLoader)
+            image_size = None
+            image = config.get('global', {}).get('image')
+            if options.image_dir and image and \
+               os.path.exists(os.path.join(options.image_dir, image)):
+                image_size = os.path.getsize(os.path.join(options.image_dir,
+                                                          image))
+            planner = ULI.Planner(config, options.root, image_size)
+            plans[path] = planner.plan()
+        except (ULI.UliException, yaml.YAMLError, IOError, KeyError,
+                TypeError, AttributeError), e:
+            failed = True
+            sys.stderr.write("%s: %s\n" % (path, getattr(e, 'err', e)))
+            continue
+
+        if not options.json:
+            print("## %s" % path)
+            print(planner.text())
+            print
+
+    if options.json:
+        json.dump(plans, sys.stdout, indent=1)
+        print
+
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == "__main__":
+    main()
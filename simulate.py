@@ -0,0 +1,123 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""Simulate a wave of installers against a backend.py daemon
+
+Every fake installer asks for an image streaming slot (queueing like
+Installer.acquire_slot), downloads the image, reports its progress and
+gives the slot back. Nothing is written to disk. The time spent queued
+and streaming per host and the aggregate throughput tell how --slots and
+--bandwidth of the backend should be set for a rack powering on.
+
+Usage: simulate.py [options] <backend host:port> <image>
+"""
+
+import sys
+import json
+import time
+import random
+import threading
+import optparse
+
+import ULI
+
+
+def installer(i, backend, image, options, results):
+    """One fake installer, adds its timings to results"""
+
+    mac = "02_00_00_00_%02x_%02x" % (i / 256, i % 256)
+    base = "http://%s/orchestrator" % backend
+    fetcher = ULI.Fetcher()
+    reporter = ULI.Reporter("%s/events/%s" % (base, mac), options.interval)
+    reporter.start()
+    result = {'mac': mac, 'queued': 0, 'positions': [], 'bytes': 0}
+    start = time.time()
+
+    try:
+        while True:
+            response = fetcher.open("%s/admission/%s" % (base, mac), "POST")
+            answer = json.loads(response.read())
+            fetcher.release(response)
+            if answer['granted']:
+                break
+            result['positions'].append(answer['position'])
+            time.sleep(answer['retry'] * random.uniform(0.8, 1.2))
+        result['queued'] = time.time() - start
+
+        streaming = time.time()
+        response = fetcher.open("http://%s/images/%s" % (backend, image))
+        size = int(response.getheader('content-length') or 0)
+        while True:
+            data = response.read(ULI.CHUNK_SIZE)
+            if not data:
+                break
+            result['bytes'] += len(data)
+            reporter.progress(image, result['bytes'], size)
+        fetcher.release(response)
+        result['streaming'] = time.time() - streaming
+
+        response = fetcher.open("%s/admission/%s" % (base, mac), "DELETE")
+        response.read()
+        fetcher.release(response)
+        reporter.stop("done")
+    except Exception, e:
+        result['error'] = str(e)
+        reporter.stop("failed", str(e))
+
+    results.append(result)
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option("--hosts", type="int", default=20,
+                      help="number of fake installers [%default]")
+    parser.add_option("--stagger", type="float", default=0,
+                      help="seconds between the installers starting "
+                           "[%default]")
+    parser.add_option("--interval", type="float", default=2,
+                      help="reporting interval in seconds [%default]")
+    parser.add_option("--json", help="write the results to this file")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("backend and image needed")
+
+    results = []
+    threads = []
+    start = time.time()
+    for i in range(options.hosts):
+        t = threading.Thread(target=installer,
+                             args=(i, args[0], args[1], options, results))
+        t.start()
+        threads.append(t)
+        time.sleep(options.stagger)
+    for t in threads:
+        t.join()
+    total = time.time() - start
+
+    print("%-18s %8s %8s %8s %10s" % ("Host", "Queued", "Stream", "MB/s",
+                                      "Positions"))
+    for r in sorted(results, key=lambda r: r['mac']):
+        if 'error' in r:
+            print("%-18s failed: %s" % (r['mac'], r['error']))
+            continue
+        print("%-18s %8.1f %8.1f %8.1f %10s" %
+              (r['mac'], r['queued'], r['streaming'],
+               r['bytes'] / 1024.0 ** 2 / (r['streaming'] or 1),
+               ",".join(map(str, r['positions'][:5]))))
+
+    done = sum([r['bytes'] for r in results])
+    print("\n%d hosts, %.1f MB in %.1f s: %.1f MB/s aggregate, "
+          "max. %.1f s queued" %
+          (len(results), done / 1024.0 ** 2, total,
+           done / 1024.0 ** 2 / total,
+           max([r['queued'] for r in results] + [0])))
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    sys.exit([r for r in results if 'error' in r] and 1 or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""Range parsing of backend.py"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend import parse_range
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_range(self):
+        self.assertEqual(parse_range("bytes=0-0", 100), (0, 0))
+        self.assertEqual(parse_range("bytes=10-19", 100), (10, 19))
+        self.assertEqual(parse_range("bytes=90-200", 100), (90, 99))
+
+    def test_open_ended(self):
+        self.assertEqual(parse_range("bytes=10-", 100), (10, 99))
+        self.assertEqual(parse_range("bytes=0-", 100), (0, 99))
+
+    def test_suffix(self):
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-500", 100), (0, 99))
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_range("bytes=100-", 100), False)
+        self.assertEqual(parse_range("bytes=200-300", 100), False)
+        self.assertEqual(parse_range("bytes=-0", 100), False)
+        self.assertEqual(parse_range("bytes=-10", 0), False)
+
+    def test_ignored(self):
+        for header in (None, "", "bytes=-", "bytes=20-10", "items=0-1",
+                       "bytes=0-1,5-6"):
+            self.assertEqual(parse_range(header, 100), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""Resume decisions of Installer.step() with a journal (stubbed steps)"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ULI
+
+STEPS = [name for name, deps in ULI.Installer.steps]
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="uli-test-")
+        self.path = os.path.join(self.dir, 'journal')
+        self.config = {'global': {'image': 'a.tar'},
+                       'diskmgmt': {'disks': ['/dev/sda'],
+                                    'partitions': {1: {'size': None}}},
+                       'fs': {'/': {'dev': '/dev/sda1', 'type': 'ext3'}}}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def install(self, fail=None, broken=()):
+        """One run of all steps, returns (ran, resume hooks called)"""
+
+        ran = []
+        resumed = []
+        U = ULI.Installer(root=self.dir, backend="127.0.0.1:1", mac="test",
+                          local_config=os.path.join(self.dir, 'uli.yaml'))
+        U.start_task = U.stop_task = lambda *args: None
+        U.config = self.config
+        U.journal = ULI.Journal(self.path)
+
+        def make_step(name):
+            def step():
+                ran.append(name)
+                if name == fail:
+                    raise ULI.UliException("%s failed" % name)
+            return step
+
+        def make_resume(name):
+            def resume():
+                resumed.append(name)
+                return name not in broken
+            return resume
+
+        for name in STEPS:
+            setattr(U, name, make_step(name))
+            setattr(U, "resume_%s" % name, make_resume(name))
+        try:
+            for name in STEPS:
+                U.step(name)
+        except ULI.UliException:
+            pass
+        return ran, resumed
+
+    def test_fresh_and_resumed(self):
+        self.assertEqual(self.install()[0], STEPS)
+        self.assertEqual(self.install()[0], [])
+
+    def test_failed_step_reruns(self):
+        ran, resumed = self.install(fail='grub')
+        self.assertEqual(ran, STEPS)
+        ran, resumed = self.install()
+        self.assertEqual(ran, ['grub'])
+
+    def test_partitions_changed(self):
+        self.install()
+        self.config['diskmgmt']['partitions'][2] = {'size': 100}
+        ran, resumed = self.install()
+        ## verify_disks is resumed first, but has to tear down the arrays
+        ## and VGs before partitioning runs again
+        self.assertEqual(ran[:2], ['verify_disks', 'partitioning'])
+        self.assertTrue('mdadm' in ran and 'filesystems' in ran)
+
+    def test_failed_resume_redoes_teardown(self):
+        self.install()
+        ran, resumed = self.install(broken=('mdadm',))
+        self.assertEqual(ran[:2], ['verify_disks', 'mdadm'])
+        self.assertFalse('partitioning' in ran)
+        ## partitioning was restored again after the teardown
+        self.assertEqual(resumed.count('partitioning'), 2)
+
+    def test_failed_install_redoes_filesystems(self):
+        ran, resumed = self.install(fail='install')
+        ran, resumed = self.install()
+        self.assertEqual(ran[:2], ['filesystems', 'install'])
+        self.assertFalse('partitioning' in ran)
+
+    def test_image_changed(self):
+        self.install()
+        self.config['global']['image'] = 'b.tar'
+        ran, resumed = self.install()
+        self.assertTrue('filesystems' in ran and 'install' in ran)
+        self.assertFalse('mdadm' in ran)
+
+    def test_journal_file(self):
+        journal = ULI.Journal(self.path)
+        journal.add('a', "1")
+        journal.add('b', "2")
+        journal.invalidate(['a'])
+        journal = ULI.Journal(self.path)
+        self.assertFalse(journal.done('a', "1"))
+        self.assertTrue(journal.done('b', "2"))
+        self.assertFalse(journal.done('b', "3"))
+        journal.clear()
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""Pure helpers of ULI.py"""
+
+import os
+import sys
+import threading
+import unittest
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ULI
+
+EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(
+                       os.path.abspath(__file__))), 'uli.yaml')
+
+
+class RunGraphTest(unittest.TestCase):
+
+    STEPS = [('a', ()), ('b', ('a',)), ('c', ('a',)), ('d', ('b', 'c'))]
+
+    def run_steps(self, steps, workers=None):
+        ran = []
+        lock = threading.Lock()
+
+        def func(name):
+            with lock:
+                ran.append(name)
+        ULI.run_graph(steps, func, workers)
+        return ran
+
+    def test_dependency_order(self):
+        for workers in (None, 1, 2):
+            ran = self.run_steps(self.STEPS, workers)
+            self.assertEqual(sorted(ran), ['a', 'b', 'c', 'd'])
+            self.assertEqual(ran[0], 'a')
+            self.assertEqual(ran[-1], 'd')
+
+    def test_installer_steps(self):
+        ran = self.run_steps(ULI.Installer.steps)
+        for name, deps in ULI.Installer.steps:
+            for d in deps:
+                self.assertTrue(ran.index(d) < ran.index(name))
+
+    def test_cycle(self):
+        steps = [('a', ()), ('b', ('c',)), ('c', ('b',))]
+        self.assertRaises(Exception, self.run_steps, steps)
+
+    def test_unknown_dependency(self):
+        self.assertRaises(Exception, self.run_steps, [('a', ('x',))])
+
+    def test_inline_order(self):
+        self.assertRaises(Exception, self.run_steps,
+                          [('b', ('a',)), ('a', ())], 1)
+
+    def test_failure(self):
+        ran = []
+
+        def func(name):
+            ran.append(name)
+            if name == 'b':
+                raise ULI.UliException("b failed")
+        self.assertRaises(ULI.UliException, ULI.run_graph,
+                          [('a', ()), ('b', ('a',)), ('c', ('b',))], func)
+        self.assertFalse('c' in ran)
+
+
+class MountOrderTest(unittest.TestCase):
+
+    def test_nested(self):
+        self.assertEqual(ULI.mount_order(['/usr/local', '/', '/var', '/usr']),
+                         [['/'], ['/usr', '/var'], ['/usr/local']])
+
+    def test_prefix_is_no_parent(self):
+        self.assertEqual(ULI.mount_order(['/', '/usr', '/usrdata',
+                                          '/usr/share/doc']),
+                         [['/'], ['/usr', '/usrdata'], ['/usr/share/doc']])
+
+    def test_missing_level(self):
+        self.assertEqual(ULI.mount_order(['/', '/var/lib/mysql']),
+                         [['/'], ['/var/lib/mysql']])
+
+
+class SignatureRangesTest(unittest.TestCase):
+
+    def test_large_device(self):
+        size = 10 * 1024 ** 3 + 12345
+        head, tail = ULI.signature_ranges(size)
+        self.assertEqual(head, (0, ULI.WIPE_BLOCK))
+        ## md 0.90: last 64K aligned 64K block
+        self.assertEqual(tail[0] % ULI.MD_RESERVED, 0)
+        self.assertTrue(ULI.MD_RESERVED <= size - tail[0] <
+                        2 * ULI.MD_RESERVED)
+        self.assertEqual(sum(tail), size)
+
+    def test_small_device(self):
+        self.assertEqual(ULI.signature_ranges(ULI.WIPE_BLOCK),
+                         [(0, ULI.WIPE_BLOCK)])
+        self.assertEqual(ULI.signature_ranges(1000), [(0, 1000)])
+
+
+class ValidateConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = yaml.load(open(EXAMPLE).read(),
+                                Loader=ULI.ConfigLoader)
+
+    def errors(self):
+        return ULI.validate_config(self.config)
+
+    def test_example(self):
+        self.assertEqual(self.errors(), [])
+
+    def test_not_a_mapping(self):
+        self.assertEqual(ULI.validate_config([]), ["Config is not a mapping"])
+
+    def test_missing_section(self):
+        del self.config['fs']
+        self.assertEqual(self.errors(), ["fs section is missing"])
+
+    def test_too_many_partitions(self):
+        self.config['diskmgmt']['partitions'][5] = {'size': 100, 'type': "fd"}
+        self.assertTrue("You cannot create more than 4 partitions in U.L.I"
+                        in self.errors())
+
+    def test_undefined_device(self):
+        self.config['fs']['/srv'] = {'dev': '/dev/rootvg/srvlv',
+                                     'type': "ext3"}
+        self.assertEqual(self.errors(),
+                         ["fs /srv: device /dev/rootvg/srvlv is not defined "
+                          "in diskmgmt/lvm"])
+
+    def test_vg_too_small(self):
+        self.config['lvm']['vg']['rootvg']['lv']['usrlv'] = "20G"
+        errors = self.errors()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("VG rootvg: LVs need"))
+
+    def test_no_root(self):
+        self.config['fs']['/data'] = self.config['fs'].pop('/')
+        self.assertEqual(self.errors(), ["No / filesystem"])
+
+
+if __name__ == "__main__":
+    unittest.main()
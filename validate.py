@@ -0,0 +1,107 @@
+# -*- coding: utf-8; tab-width: 4 -*-
+
+"""Validate all U.L.I. configs of a backend and prevalidate them
+
+Parses and checks (ULI.validate_config) every *.yaml config in the
+directory in parallel. Every valid config is written next to it as
+<name>.json, which installers download instead of the YAML: no YAML
+parsing on the installer and a config known to be good. An index.json
+records the sha256 and the result of every config, so unchanged configs
+are skipped on the next run. Exits non-zero if any config is invalid.
+
+Rerun it after editing a config. Until then backend.py doesn't serve the
+stale JSON, and installers skip it if the YAML has a <name>.yaml.sha256.
+
+Usage: validate.py [options] <config dir>
+"""
+
+import os
+import sys
+import json
+import yaml
+import hashlib
+import optparse
+import multiprocessing
+
+import ULI
+
+
+def check(path):
+    """Validate one config, returns (name, sha256, config, errors)"""
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    data = open(path).read()
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        config = yaml.load(data, Loader=ULI.ConfigLoader)
+        errors = ULI.validate_config(config)
+    except yaml.YAMLError, e:
+        config, errors = None, ["YAML error: %s" % e]
+    return name, digest, config, errors
+
+
+def compile_config(path, digest, config):
+    """Write the prevalidated JSON of a config (atomic)"""
+
+    with open("%s.part" % path, 'w') as f:
+        ## YAML dates and timestamps become strings
+        json.dump({'uli_config': 1, 'sha256': digest, 'config': config}, f,
+                  default=str)
+    os.rename("%s.part" % path, path)
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option("--jobs", type="int", default=0,
+                      help="parallel workers (0: one per CPU) [%default]")
+    parser.add_option("--index", help="index file [<config dir>/index.json]")
+    parser.add_option("--no-json", action="store_true",
+                      help="only validate, don't write <name>.json")
+    options, args = parser.parse_args()
+
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error("no config directory given")
+
+    index_path = options.index or os.path.join(args[0], 'index.json')
+    try:
+        index = json.load(open(index_path))
+    except (IOError, ValueError):
+        index = {}
+
+    paths = sorted([os.path.join(args[0], p) for p in os.listdir(args[0])
+                    if p.endswith('.yaml')])
+    pool = multiprocessing.Pool(options.jobs or None)
+    results = pool.map(check, paths, chunksize=16)
+    pool.close()
+
+    failed = 0
+    for path, (name, digest, config, errors) in zip(paths, results):
+        json_path = "%s.json" % os.path.splitext(path)[0]
+        if errors:
+            failed += 1
+            for e in errors:
+                sys.stderr.write("%s: %s\n" % (path, e))
+            ## Never leave a stale prevalidated config behind
+            if os.path.exists(json_path):
+                os.unlink(json_path)
+        elif not options.no_json and \
+             (index.get(name, {}).get('sha256') != digest or
+              not os.path.exists(json_path)):
+            compile_config(json_path, digest, config)
+        index[name] = {'sha256': digest, 'valid': not errors,
+                       'errors': errors}
+
+    for name in list(index):
+        if not os.path.exists(os.path.join(args[0], "%s.yaml" % name)):
+            del index[name]
+
+    with open("%s.part" % index_path, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True, default=str)
+    os.rename("%s.part" % index_path, index_path)
+
+    print("%d configs, %d invalid" % (len(paths), failed))
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == "__main__":
+    main()